@@ -9,6 +9,16 @@ from lifeguard.jira_api import JiraApi
 jira = JiraApi()
 jira.new_connect()
 
+from lifeguard.one.cache import TtlCache
+vm_inventory = TtlCache(ttl_seconds=app.config['VM_INVENTORY_CACHE_TTL_S'], name='vm inventory cache')
+cluster_maps = TtlCache(ttl_seconds=app.config['CLUSTER_MAP_CACHE_TTL_S'], name='cluster map cache')
+
+from lifeguard.views.template.models import TemplateCache
+templates = TemplateCache(max_size=app.config['TEMPLATE_CACHE_SIZE'])
+
+from lifeguard.sync.inventory import InventorySync
+inventory_sync = InventorySync()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
@@ -1,4 +1,4 @@
-from lifeguard import app, jira
+from lifeguard import app, jira, inventory_sync
 from lifeguard.database import Session
 from lifeguard.views.vpool.models import PoolMemberDiagnostic
 from lifeguard.views.vpool.health import Diagnostic
@@ -6,8 +6,28 @@ from lifeguard.tasks import all_pools_and_members
 from threading import Thread
 from queue import Queue
 import logging
+import os
+import time
 import traceback
 
+def full_run_due():
+  """
+  With HEALTH_CHECK_CHANGED_ONLY only pools whose VMs changed in ONE are
+  checked, which misses e.g. a hung guest of a VM ONE still has RUNNING, so
+  every pool is still checked at least every HEALTH_CHECK_FULL_EVERY_S
+  :return: True if this run must check every pool
+  """
+  if not app.config['HEALTH_CHECK_CHANGED_ONLY']:
+    return True
+  try:
+    last = os.path.getmtime(full_run_marker())
+  except FileNotFoundError:
+    return True
+  return time.time() - last >= app.config['HEALTH_CHECK_FULL_EVERY_S']
+
+def full_run_marker():
+  return os.path.join(app.config['INVENTORY_SNAPSHOT_DIR'], 'health-tasks-full-run')
+
 def worker(q, number):
   while True:
     work = q.get()
@@ -45,8 +65,18 @@ def run():
     filename=app.config['LOG_FILE_HEALTH_CHECKER'],
     level=app.config['LOG_LEVEL'] if app.config['LOG_LEVEL'] else 'INFO')
   logging.info("ticket creation script started")
+  # so HEALTH_CHECK_CHANGED_ONLY checks what changed since this script's last run
+  inventory_sync.persist(app.config['INVENTORY_SNAPSHOT_DIR'], 'health_tasks')
   q = Queue()
-  for (pool, members)  in all_pools_and_members():
+  # the workers are started first so they pick up each zone's members as
+  # soon as its inventory has been fetched
+  for i in range(app.config['NUM_HEALTH_CHECK_THREADS']):
+    t = Thread(target=worker, kwargs={'q': q, 'number': i})
+    t.daemon = True
+    t.start()
+  full_run = full_run_due()
+  logging.info("checking {} pools".format("all" if full_run else "only changed"))
+  for (pool, members)  in all_pools_and_members(changed_only=not full_run):
     for member in members:
       q.put({'member': member,
              'vm': member.vm,
@@ -55,10 +85,8 @@ def run():
                                       ssh_identity_file=app.config['SSH_IDENTITY_FILE'],
                                       cmd=app.config['SSH_HEALTH_CHECK_CMD'],
                                       timeout=app.config['SSH_HEALTH_CHECK_TIMEOUT'])})
-
-  for i in range(app.config['NUM_HEALTH_CHECK_THREADS']):
-    t = Thread(target=worker, kwargs={'q': q, 'number': i})
-    t.daemon = True
-    t.start()
   q.join()
+  if full_run:
+    with open(full_run_marker(), 'w'):
+      pass
   print("queue is empty, exiting")
\ No newline at end of file
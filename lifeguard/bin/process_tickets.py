@@ -161,10 +161,8 @@ def process_tickets(cowbow_mode, plan, implement):
   logging.info("****************************************")
   logging.info("**** ticket creation script started ****")
   logging.info("****************************************")
-  for (pool, members)  in all_pools_and_members():
-    logging.info("retreived pool: {}".format(pool.name))
-    q.put({'pool': pool,
-           'members': members})
+  # the workers are started first so they pick up each zone's pools as soon
+  # as its inventory has been fetched
   for i in range(app.config['NUM_HEALTH_CHECK_THREADS']):
     t = Thread(target=worker, kwargs={'q': q,
                                       'name': 'worker_{}'.format(i),
@@ -173,6 +171,10 @@ def process_tickets(cowbow_mode, plan, implement):
                                       'implement': implement})
     t.daemon = True
     t.start()
+  for (pool, members)  in all_pools_and_members():
+    logging.info("retreived pool: {}".format(pool.name))
+    q.put({'pool': pool,
+           'members': members})
   q.join()
   logging.info("Queue is now empty, {} threads created".format(len(threads)))
   for t in threads:
@@ -0,0 +1,71 @@
+import sys, os, getopt, logging, time
+from lifeguard import app, inventory_sync
+from lifeguard.database import Session
+from lifeguard.views.vpool.models import VmInventory
+from lifeguard.views.zone.models import Zone
+import traceback
+
+def refresh_zone(zone, full=False):
+  """
+  Syncs the zone's VMs from ONE and applies the changes to the vm_inventory table
+  :param zone:
+  :param full: rewrite all the zone's rows rather than only those that changed
+  :return: the InventoryDelta
+  """
+  start = time.monotonic()
+  delta, vms = zone.sync_vm_inventory()
+  VmInventory.apply(zone.number, delta, vms, full=full)
+  logging.info("refreshed vm inventory of zone {} in {:.1f}s: {}".format(
+    zone.name, time.monotonic() - start, delta))
+  return delta
+
+def refresh_inventory(interval_s):
+  logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(message)s',
+    filename=app.config['LOG_FILE_INVENTORY_REFRESHER'],
+    level=app.config['LOG_LEVEL'] if app.config['LOG_LEVEL'] else 'INFO')
+  logging.info("inventory refresh script started")
+  inventory_sync.persist(app.config['INVENTORY_SNAPSHOT_DIR'], 'refresh_inventory')
+  # the rows may have drifted from the persisted snapshots while we weren't
+  # running so the first pass rewrites every zone, as does the pass after a
+  # failure as the delta that failed to apply is gone
+  rewrite = None
+  while True:
+    failed = set()
+    for zone in Session.query(Zone).all():
+      try:
+        refresh_zone(zone, full=rewrite is None or zone.number in rewrite)
+      except Exception as e:
+        Session.rollback()
+        failed.add(zone.number)
+        logging.error("failed to refresh vm inventory of zone {}: {}\n{}".format(
+          zone.name, e, traceback.format_exc()))
+    Session.remove()
+    rewrite = failed
+    if not interval_s:
+      break
+    time.sleep(interval_s)
+  logging.info("finished")
+
+def usage():
+  print("Usage: /path/to/python {} [<options>]".format(os.path.basename(__file__)))
+  print("Options:")
+  print("\t--interval=<seconds> (keep refreshing every <seconds>, 0 to refresh once, "
+        "defaults to INVENTORY_REFRESH_INTERVAL_S)")
+  print("\t-h, --help (this message)")
+
+def run():
+  interval_s = app.config['INVENTORY_REFRESH_INTERVAL_S']
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "interval="])
+    for opt, arg in opts:
+      if opt in ['-h', '--help']:
+        usage()
+        sys.exit()
+      elif opt == "--interval":
+        interval_s = int(arg)
+  except Exception as err:
+    print(str(err))
+    usage()
+    sys.exit(2)
+  refresh_inventory(interval_s)
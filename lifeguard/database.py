@@ -14,6 +14,7 @@ def init_db():
     from lifeguard.views.task.models import Task
     from lifeguard.views.vpool.models import VirtualMachinePool
     from lifeguard.views.vpool.models import PoolMembership
+    from lifeguard.views.vpool.models import VmInventory, VmInventoryRefresh
     from lifeguard.views.zone.models import Zone
     Base.metadata.create_all(bind=engine)
 
@@ -1,9 +1,20 @@
 class Cluster:
+  """
+  Slotted and immutable like VirtualMachine as every VM references one
+  """
+  __slots__ = ('id', 'name')
+
   def __init__(self,
                id=None,
                name=None):
-    self.id = id
-    self.name = name
+    object.__setattr__(self, 'id', id)
+    object.__setattr__(self, 'name', name)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("Cluster is immutable, cannot set {}".format(name))
+
+  def __reduce__(self):
+    return Cluster, (self.id, self.name)
 
   @staticmethod
   def from_xml_etree(etree):
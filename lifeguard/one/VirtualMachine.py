@@ -1,4 +1,76 @@
+from sys import intern
+
+STATE_BY_ID = {0: 'INIT',
+               1: 'PENDING',
+               2: 'HOLD',
+               3: 'ACTIVE',
+               4: 'STOPPED',
+               5: 'SUSPENDED',
+               6: 'DONE',
+               7: 'FAILED',
+               8: 'POWEROFF',
+               9: 'UNDEPLOYED'}
+
+LCM_STATE_BY_ID = {0: 'LCM_INIT',
+                   1: 'PROLOG',
+                   2: 'BOOT',
+                   3: 'RUNNING',
+                   4: 'MIGRATE',
+                   5: 'SAVE_STOP',
+                   6: 'SAVE_SUSPEND',
+                   7: 'SAVE_MIGRATE',
+                   8: 'PROLOG_MIGRATE',
+                   9: 'PROLOG_RESUME',
+                   10: 'EPILOG_STOP',
+                   11: 'EPILOG',
+                   12: 'SHUTDOWN',
+                   13: 'CANCEL',
+                   14: 'FAILURE',
+                   15: 'CLEANUP_RESUBMIT',
+                   16: 'UNKNOWN',
+                   17: 'HOTPLUG',
+                   18: 'SHUTDOWN_POWEROFF',
+                   19: 'BOOT_UNKNOWN',
+                   20: 'BOOT_POWEROFF',
+                   21: 'BOOT_SUSPENDED',
+                   22: 'BOOT_STOPPED',
+                   23: 'CLEANUP_DELETE',
+                   24: 'HOTPLUG_SNAPSHOT',
+                   25: 'HOTPLUG_NIC',
+                   26: 'HOTPLUG_SAVEAS',
+                   27: 'HOTPLUG_SAVEAS_POWEROFF',
+                   28: 'HOTPLUG_SAVEAS_SUSPENDED',
+                   29: 'SHUTDOWN_UNDEPLOY',
+                   30: 'EPILOG_UNDEPLOY',
+                   31: 'PROLOG_UNDEPLOY',
+                   32: 'BOOT_UNDEPLOY'}
+
 class VirtualMachine:
+  """
+  Tens of thousands of these are kept alive per zone so they are slotted and
+  immutable (they are shared between threads and web requests), use replace()
+  to derive a modified copy.  Strings repeated across many VMs are interned.
+  """
+  __slots__ = ('id',
+               'name',
+               'state',
+               'state_id',
+               'lcm_state',
+               'lcm_state_id',
+               'stime',
+               'memory',
+               'cpu',
+               'vcpu',
+               'disk_cluster',
+               'disk_cluster_id',
+               'disk_datastore_id',
+               'disk_datastore_name',
+               'image_name',
+               'image_id',
+               'ip_address',
+               'template_id',
+               'vanished')
+
   def __init__(self,
                id=None,
                name=None,
@@ -17,108 +89,127 @@ class VirtualMachine:
                image_name=None,
                image_id=None,
                ip_address=None,
-               template_id=None):
-    self.id = id
-    self.name = name
-    self.state_id = state_id
-    self.state = state
-    self.lcm_state = lcm_state
-    self.lcm_state_id = lcm_state_id
-    self.stime = stime
-    self.memory = memory
-    self.cpu = cpu
-    self.vcpu = vcpu
-    self.disk_cluster = disk_cluster
-    self.disk_cluster_id = disk_cluster_id
-    self.disk_datastore_id = disk_datastore_id
-    self.disk_datastore_name = disk_datastore_name
-    self.image_name = image_name
-    self.image_id = image_id
-    self.ip_address = ip_address
-    self.template_id = template_id
+               template_id=None,
+               vanished=False):
+    set = object.__setattr__
+    set(self, 'id', id)
+    set(self, 'name', name)
+    set(self, 'state', None if state is None else intern(state))
+    set(self, 'state_id', state_id)
+    set(self, 'lcm_state', None if lcm_state is None else intern(lcm_state))
+    set(self, 'lcm_state_id', lcm_state_id)
+    set(self, 'stime', stime)
+    set(self, 'memory', memory)
+    set(self, 'cpu', cpu)
+    set(self, 'vcpu', vcpu)
+    set(self, 'disk_cluster', disk_cluster)
+    set(self, 'disk_cluster_id', disk_cluster_id)
+    set(self, 'disk_datastore_id', disk_datastore_id)
+    set(self, 'disk_datastore_name', None if disk_datastore_name is None else intern(disk_datastore_name))
+    set(self, 'image_name', None if image_name is None else intern(image_name))
+    set(self, 'image_id', image_id)
+    set(self, 'ip_address', ip_address)
+    set(self, 'template_id', template_id)
+    set(self, 'vanished', vanished)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("VirtualMachine is immutable, use replace() to set {}".format(name))
+
+  def __delattr__(self, name):
+    raise AttributeError("VirtualMachine is immutable, cannot delete {}".format(name))
+
+  def __reduce__(self):
+    return VirtualMachine, tuple(getattr(self, attr) for attr in VirtualMachine.__slots__)
+
+  def replace(self, **changes):
+    """
+    Returns a copy of the VM with the given attributes changed
+    :param changes:
+    :return:
+    """
+    attrs = {attr: getattr(self, attr) for attr in VirtualMachine.__slots__}
+    attrs.update(changes)
+    return VirtualMachine(**attrs)
+
+  @staticmethod
+  def vanished_placeholder(id, name):
+    """
+    Stands in for a VM that is still referenced (e.g. by a pool membership)
+    but no longer exists in ONE.  It reports as DONE so it gets cleaned up.
+    :param id:
+    :param name:
+    :return:
+    """
+    return VirtualMachine(
+      id=id,
+      name=name,
+      state='VANISHED',
+      state_id=6,
+      lcm_state='LCM_INIT',
+      lcm_state_id=0,
+      memory=0,
+      cpu=0.0,
+      vanished=True)
 
   @staticmethod
   def state_by_id(id):
-    state = {0: 'INIT',
-             1: 'PENDING',
-             2: 'HOLD',
-             3: 'ACTIVE',
-             4: 'STOPPED',
-             5: 'SUSPENDED',
-             6: 'DONE',
-             7: 'FAILED',
-             8: 'POWEROFF',
-             9: 'UNDEPLOYED'}
-    return state[id]
+    return STATE_BY_ID[id]
 
   @staticmethod
   def lcm_state_by_id(id):
-    state = {0: 'LCM_INIT',
-             1: 'PROLOG',
-             2: 'BOOT',
-             3: 'RUNNING',
-             4: 'MIGRATE',
-             5: 'SAVE_STOP',
-             6: 'SAVE_SUSPEND',
-             7: 'SAVE_MIGRATE',
-             8: 'PROLOG_MIGRATE',
-             9: 'PROLOG_RESUME',
-             10: 'EPILOG_STOP',
-             11: 'EPILOG',
-             12: 'SHUTDOWN',
-             13: 'CANCEL',
-             14: 'FAILURE',
-             15: 'CLEANUP_RESUBMIT',
-             16: 'UNKNOWN',
-             17: 'HOTPLUG',
-             18: 'SHUTDOWN_POWEROFF',
-             19: 'BOOT_UNKNOWN',
-             20: 'BOOT_POWEROFF',
-             21: 'BOOT_SUSPENDED',
-             22: 'BOOT_STOPPED',
-             23: 'CLEANUP_DELETE',
-             24: 'HOTPLUG_SNAPSHOT',
-             25: 'HOTPLUG_NIC',
-             26: 'HOTPLUG_SAVEAS',
-             27: 'HOTPLUG_SAVEAS_POWEROFF',
-             28: 'HOTPLUG_SAVEAS_SUSPENDED',
-             29: 'SHUTDOWN_UNDEPLOY',
-             30: 'EPILOG_UNDEPLOY',
-             31: 'PROLOG_UNDEPLOY',
-             32: 'BOOT_UNDEPLOY'}
-    return state[id]
+    return LCM_STATE_BY_ID[id]
 
   @staticmethod
-  def from_xml_etree(etree):
-    vm = VirtualMachine(
-      id=int(etree.find('ID').text),
-      name=etree.find('NAME').text,
-      state=VirtualMachine.state_by_id(int(etree.find('STATE').text)),
-      state_id=int(etree.find('STATE').text),
-      lcm_state=VirtualMachine.lcm_state_by_id(int(etree.find('LCM_STATE').text)),
-      lcm_state_id=int(etree.find('LCM_STATE').text),
-      stime=int(etree.find('STIME').text),
-      memory=int(etree.find('TEMPLATE').find('MEMORY').text),
-      cpu=float(etree.find('TEMPLATE').find('CPU').text))
-    if etree.find('TEMPLATE').find('TEMPLATE_ID') is not None:
-      vm.template_id=int(etree.find('TEMPLATE').find('TEMPLATE_ID').text)
-    if etree.find('TEMPLATE').find('DISK') is not None:
-      vm.disk_cluster_id=int(etree.find('TEMPLATE').find('DISK').find('CLUSTER_ID').text)
-      vm.disk_datastore_id=int(etree.find('TEMPLATE').find('DISK').find('DATASTORE_ID').text)
-      vm.disk_datastore_name=etree.find('TEMPLATE').find('DISK').find('DATASTORE').text
-      vm.image_name=etree.find('TEMPLATE').find('DISK').find('IMAGE').text
-      vm.image_id=int(etree.find('TEMPLATE').find('DISK').find('IMAGE_ID').text)
-    if etree.find('TEMPLATE').find('NIC') is not None:
-      vm.ip_address = etree.find('TEMPLATE').find('NIC').find('IP').text
-    if etree.find('TEMPLATE').find('VCPU') is not None:
-      vm.vcpu = float(etree.find('TEMPLATE').find('VCPU').text)
-    return vm
+  def from_xml_etree(etree, clusters=None):
+    """
+    Builds a VM from its <VM> element.  Each element is located exactly once
+    with the C implemented find()/findtext(), which measures cheaper than
+    walking every child in Python as a <VM> has dozens we don't use.
+    :param etree:
+    :param clusters: dict of cluster ID to Cluster used to set disk_cluster
+    :return:
+    """
+    template = etree.find('TEMPLATE')
+    state_id = int(etree.findtext('STATE'))
+    lcm_state_id = int(etree.findtext('LCM_STATE'))
+    vcpu = template.findtext('VCPU')
+    template_id = template.findtext('TEMPLATE_ID')
+    disk = template.find('DISK')
+    disk_cluster_id = disk_datastore_id = disk_datastore_name = image_name = image_id = disk_cluster = None
+    if disk is not None:
+      disk_cluster_id = int(disk.findtext('CLUSTER_ID'))
+      disk_datastore_id = int(disk.findtext('DATASTORE_ID'))
+      disk_datastore_name = disk.findtext('DATASTORE')
+      image_name = disk.findtext('IMAGE')
+      image_id = int(disk.findtext('IMAGE_ID'))
+      if clusters is not None:
+        disk_cluster = clusters.get(disk_cluster_id)
+    nic = template.find('NIC')
+    return VirtualMachine(
+      id=int(etree.findtext('ID')),
+      name=etree.findtext('NAME'),
+      state=STATE_BY_ID[state_id],
+      state_id=state_id,
+      lcm_state=LCM_STATE_BY_ID[lcm_state_id],
+      lcm_state_id=lcm_state_id,
+      stime=int(etree.findtext('STIME')),
+      memory=int(template.findtext('MEMORY')),
+      cpu=float(template.findtext('CPU')),
+      vcpu=None if vcpu is None else float(vcpu),
+      disk_cluster=disk_cluster,
+      disk_cluster_id=disk_cluster_id,
+      disk_datastore_id=disk_datastore_id,
+      disk_datastore_name=disk_datastore_name,
+      image_name=image_name,
+      image_id=image_id,
+      ip_address=None if nic is None else nic.findtext('IP'),
+      template_id=None if template_id is None else int(template_id))
 
   def memory_gb(self):
     return round(self.memory / 1024, 0)
 
   def state_desc(self):
-    if self.state is "ACTIVE":
+    if self.state == "ACTIVE":
       return self.lcm_state
     else:
       return self.state
@@ -1,8 +1,11 @@
-import xmlrpc.client
 import xml.etree.ElementTree as etree
-import ssl
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from lifeguard.one.VirtualMachine import VirtualMachine
 from lifeguard.one.Cluster import Cluster
+from lifeguard.one.transport import PooledServerProxy, get_pool
+from lifeguard.one.batch import CallBatch, get_window_batcher, run_calls, resolve as resolve_call
 import time
 
 # http://docs.opennebula.org/4.10/integration/system_interfaces/api.html
@@ -22,21 +25,264 @@ UNLIMITED = -1
 EXCEPT_DONE = -1
 INCLUDING_DONE = -2
 
+# ONE API error code for a resource that does not exist
+NO_EXISTS = 0x0400
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_PAGE_WORKERS = 4
+DEFAULT_LOOKUP_WORKERS = 8
+DEFAULT_ACTION_WORKERS = 8
+
+# kill_vms polls the state of the VMs being killed starting this often,
+# doubling the interval after each poll up to the maximum
+DEFAULT_KILL_POLL_S = 1
+DEFAULT_KILL_MAX_POLL_S = 30
+DEFAULT_KILL_TIMEOUT_S = 600
+# a VM that isn't DONE this long after ONE accepted a kill command gets the
+# next, harsher, one
+DEFAULT_KILL_ESCALATE_S = 60
+
+STOPPED_STATE_ID = 4
+SUSPENDED_STATE_ID = 5
+DONE_STATE_ID = 6
+# this and every later state (POWEROFF, UNDEPLOYED...) has no guest running
+FAILED_STATE_ID = 7
+
+VM_ACTIONS = ["shutdown",
+              "shutdown-hard",
+              "hold",
+              "release",
+              "stop",
+              "suspend",
+              "resume",
+              "boot",
+              "delete",
+              "delete-recreate",
+              "reboot",
+              "reboot-hard",
+              "resched",
+              "unresched",
+              "poweroff",
+              "poweroff-hard",
+              "undeploy",
+              "undeploy-hard"]
+
+
+def iter_vms_from_xml(xml, clusters=None):
+  """
+  Incrementally parses a VM_POOL document yielding a VirtualMachine as each
+  top level <VM> element closes.  Processed elements are cleared from the
+  root as we go so the DOM of the whole pool is never held in memory at once.
+  :param xml: the VM_POOL document returned by one.vmpool.info
+  :param clusters: dict of cluster ID to Cluster used to set disk_cluster
+  :return: generator of VirtualMachine objects in document order
+  """
+  root = None
+  depth = 0
+  for event, el in etree.iterparse(io.StringIO(xml), events=('start', 'end')):
+    if event == 'start':
+      if root is None:
+        root = el
+      depth += 1
+      continue
+    depth -= 1
+    if depth == 1 and el.tag == 'VM':
+      yield VirtualMachine.from_xml_etree(el, clusters)
+      root.clear()
+
+
+def new_kill_cmds():
+  """
+  The kill commands to try on a VM for each kind of state it can be in,
+  see kill_cmds_for.  Note these get popped off, so they are attempted in
+  reverse order.
+  :return: dict of state kind to list of commands
+  """
+  return {'pre_active': ['delete', 'delete'],
+          'active': ['delete', 'shutdown-hard', 'shutdown'],
+          'delete_only': ['delete']}
+
+
+def kill_cmds_for(cmds, state_id):
+  """
+  :param cmds: a VM's dict from new_kill_cmds
+  :param state_id: the VM's current state
+  :return: the list of commands left to try for a VM in that state
+  """
+  if state_id < 3:
+    return cmds['pre_active']
+  # a VM without a running guest can only be deleted
+  if state_id in (STOPPED_STATE_ID, SUSPENDED_STATE_ID) or state_id >= FAILED_STATE_ID:
+    return cmds['delete_only']
+  return cmds['active']
+
+
+class KillOutcome:
+  """
+  The result of killing one VM with OneProxy.kill_vms
+  """
+  def __init__(self, vm_id):
+    self.vm_id = vm_id
+    self.done = False
+    self.state = None
+    self.attempted_cmds = []
+    self.error = None
+
+  def __str__(self):
+    return 'KillOutcome: vm_id={}, done={}, state={}, attempted_cmds={}, error={}'.format(
+      self.vm_id, self.done, self.state, self.attempted_cmds, self.error)
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class BulkActionResult:
+  """
+  The result of performing one action on many VMs with OneProxy.action_vms
+  """
+  def __init__(self, action):
+    self.action = action
+    self.succeeded = []
+    self.errors = {}
+    self.elapsed_s = 0.0
+
+  def ok(self):
+    return not self.errors
+
+  def __str__(self):
+    return 'BulkActionResult: action={}, succeeded={}, failed={}, elapsed_s={:.2f}'.format(
+      self.action, len(self.succeeded), len(self.errors), self.elapsed_s)
+
+  def __repr__(self):
+    return self.__str__()
+
+
+def _parse_vm(id, response, clusters, missing_ok=False):
+  """
+  :param id:
+  :param response: the result of one.vm.info
+  :param clusters: dict of cluster ID to Cluster
+  :param missing_ok: return None rather than raise if the VM doesn't exist
+  :return: VirtualMachine
+  """
+  if response[0] is not True:
+    if missing_ok and response[2] == NO_EXISTS:
+      return None
+    raise (Exception("one.vm.info id {} failed (error code: {}) {}".format(
+      id,
+      response[2],
+      response[1])))
+  return VirtualMachine.from_xml_etree(etree.fromstring(response[1]), clusters)
+
+
+def _parse_image(id, response):
+  """
+  :param id:
+  :param response: the result of one.image.info
+  :return: dict of the image's id, name and description
+  """
+  if response[0] is not True:
+    raise (Exception("one.image.info id {} info failed (error code: {}) {}".format(
+      id,
+      response[2],
+      response[1])))
+  xml = etree.fromstring(response[1])
+  return {
+    'id': int(xml.find('ID').text),
+    'name': xml.find('ID').text,
+    'description': xml.find('DESC').text
+  }
+
+
+class OneBatch(CallBatch):
+  """
+  Lookups collected by OneProxy.batch(), each returns a Future that is
+  resolved when the batch is flushed at the end of the with block
+  """
+  def __init__(self, one_proxy, max_workers=DEFAULT_LOOKUP_WORKERS):
+    super().__init__(lambda calls: one_proxy.run_calls(calls, max_workers))
+    self.one_proxy = one_proxy
+
+  def get_vm(self, id, clusters=None, missing_ok=False):
+    """
+    :param id:
+    :param clusters: dict of cluster ID to Cluster, from the proxy if not given
+    :param missing_ok: resolve to None rather than raise if the VM doesn't exist
+    :return: Future of the VirtualMachine
+    """
+    if clusters is None:
+      clusters = self.one_proxy._cluster_map()
+    return self.call('one.vm.info', (self.one_proxy.session_string, id),
+                     lambda response: _parse_vm(id, response, clusters, missing_ok))
+
+  def get_image(self, id):
+    """
+    :param id:
+    :return: Future of the image dict
+    """
+    return self.call('one.image.info', (self.one_proxy.session_string, id),
+                     lambda response: _parse_image(id, response))
+
 
 class OneProxy:
-  def __init__(self, api_url, session_string, verify_certs=True):
+  def __init__(self, api_url, session_string, verify_certs=True, on_change=None, cluster_cache=None,
+               batch_window_s=None):
+    """
+    :param api_url:
+    :param session_string:
+    :param verify_certs:
+    :param on_change: optional callable invoked after VMs are created or
+    actioned, used to invalidate anything caching the zone's VMs
+    :param cluster_cache: optional TtlCache, shared by every proxy for the
+    zone, that memoizes the zone's clusters under its api_url
+    :param batch_window_s: if set, get_vm and get_image calls made by any
+    thread within this many seconds of each other share a system.multicall
+    """
     self.api_url = api_url
     self.session_string = session_string
     self.verify_certs = verify_certs
+    self.on_change = on_change
+    self.cluster_cache = cluster_cache
 
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+    # connections are pooled per zone and shared by every OneProxy in the
+    # process, the proxy is safe to use from any number of threads
+    self.connection_pool = get_pool(self.api_url, self.verify_certs)
+    self.proxy = PooledServerProxy(self.connection_pool)
+    self.batcher = None
+    if batch_window_s:
+      self.batcher = get_window_batcher(self.connection_pool, self.session_string, batch_window_s, self.run_calls)
 
-    if self.verify_certs:
-      ssl_context.verify_mode = ssl.CERT_OPTIONAL
-    else:
-      ssl_context.verify_mode = ssl.CERT_NONE
+  def run_calls(self, calls, max_workers=DEFAULT_LOOKUP_WORKERS):
+    """
+    Makes many calls in as few round trips as possible with system.multicall
+    :param calls: list of (method, params) tuples
+    :param max_workers: maximum number of concurrent calls when the zone
+    doesn't support system.multicall
+    :return: list with the result of each call, or the exception it raised
+    """
+    return run_calls(self.proxy, self.connection_pool, calls, max_workers=max_workers)
 
-    self.proxy = xmlrpc.client.ServerProxy(api_url, verbose=False, context=ssl_context)
+  def batch(self, max_workers=DEFAULT_LOOKUP_WORKERS):
+    """
+    Collects the lookups made on the returned batch and sends them as one
+    system.multicall when the with block ends:
+
+      with one_proxy.batch() as batch:
+        futures = [batch.get_vm(id) for id in vm_ids]
+      vms = [f.result() for f in futures]
+    :param max_workers: maximum number of concurrent calls when the zone
+    doesn't support system.multicall
+    :return: OneBatch
+    """
+    return OneBatch(self, max_workers)
+
+  def _info(self, method, id, parse):
+    """
+    Makes an info call directly, or through the window batcher if there is one
+    """
+    if self.batcher is None:
+      return parse(resolve_call(self.proxy, method)(self.session_string, id))
+    return self.batcher.submit(method, (self.session_string, id), parse).result()
 
   def rename_image(self, id, new_name):
     """
@@ -53,24 +299,17 @@ class OneProxy:
         response[2],
         response[1])))
 
+  def _changed(self):
+    if self.on_change is not None:
+      self.on_change()
+
   def get_image(self, id):
     """
     Returns an image in a given zone
     :param id:
     :return:
     """
-    response = self.proxy.one.image.info(self.session_string, id)
-    if response[0] is not True:
-      raise (Exception("one.image.info id {} info failed (error code: {}) {}".format(
-        id,
-        response[2],
-        response[1])))
-    xml = etree.fromstring(response[1])
-    return {
-      'id': int(xml.find('ID').text),
-      'name': xml.find('ID').text,
-      'description': xml.find('DESC').text
-    }
+    return self._info('one.image.info', id, lambda response: _parse_image(id, response))
 
   def find_by_attr_k_v(self, list, attr_name, attr_val):
     for item in list:
@@ -118,27 +357,29 @@ class OneProxy:
       })
     return items
 
-  def _populate_cluster_on_vms(self, vms):
+  def _cluster_map(self):
     """
-    Helper method to populate the cluster object on a VM
-    :param vms:
+    Helper method returning the zone's clusters keyed by ID, used to
+    populate the cluster object on VMs as they are parsed.  Comes from the
+    cluster cache when there is one.
     :return:
     """
-    clusters = self.get_clusters()
-    cluster_id_to_name = {}
-    for cluster in clusters:
-      cluster_id_to_name[cluster.id] = cluster
-    for vm in vms:
-      if vm.disk_cluster_id is not None and vm.disk_cluster_id in cluster_id_to_name:
-        vm.disk_cluster = cluster_id_to_name[vm.disk_cluster_id]
-    return vms
-
+    return {cluster.id: cluster for cluster in self.get_clusters()}
 
-  def get_vms(self, include_done=False):
+  def get_vms(self, include_done=False, streaming=False, page_size=None):
     """
     Returns all VMs in a given zone
+    :param include_done: include VMs in the DONE state
+    :param streaming: parse the response incrementally with iterparse instead
+    of building the DOM of the entire pool (lower peak memory for large zones)
+    :param page_size: if set the VMs are fetched concurrently in pages of
+    this many VM IDs (see iter_vms)
     :return:
     """
+    if page_size is not None:
+      items = list(self.iter_vms(include_done=include_done, page_size=page_size))
+      items.sort(key=lambda x: x.name)
+      return items
     state = EXCEPT_DONE
     if include_done:
       state = INCLUDING_DONE
@@ -147,35 +388,121 @@ class OneProxy:
       raise (Exception("one.vmpool.info failed (error code: {}) {}".format(
         response[2],
         response[1])))
-    items = []
-    for child in etree.fromstring(response[1]):
-      items.append(VirtualMachine.from_xml_etree(child))
-    self._populate_cluster_on_vms(items)
+    clusters = self._cluster_map()
+    if streaming:
+      items = list(iter_vms_from_xml(response[1], clusters))
+    else:
+      items = []
+      for child in etree.fromstring(response[1]):
+        items.append(VirtualMachine.from_xml_etree(child, clusters))
     items.sort(key=lambda x: x.name)
     return items
 
-
-  def get_vm(self, id):
+  def _get_vm_page(self, state, start_id, end_id, clusters):
     """
-    Returns a VM in a given zone
+    Fetches the VMs with IDs in the range start_id..end_id (inclusive), an
+    end_id of UNLIMITED fetches everything from start_id onwards
+    :param state:
+    :param start_id:
+    :param end_id:
+    :param clusters: dict of cluster ID to Cluster
     :return:
     """
-    response = self.proxy.one.vm.info(self.session_string, id)
+    response = self.proxy.one.vmpool.info(self.session_string, CURRENT_USER, start_id, end_id, state)
     if response[0] is not True:
-      raise (Exception("one.vm.info failed (error code: {}) {}".format(
+      raise (Exception("one.vmpool.info failed for IDs {}..{} (error code: {}) {}".format(
+        start_id,
+        end_id,
         response[2],
         response[1])))
-    xml = etree.fromstring(response[1])
-    vm = VirtualMachine.from_xml_etree(xml)
-    return self._populate_cluster_on_vms([vm])[0]
+    return list(iter_vms_from_xml(response[1], clusters))
 
+  def iter_vms(self, include_done=False, page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_PAGE_WORKERS):
+    """
+    Generator of all VMs in a given zone fetched in pages of VM ID ranges
+    by a small pool of threads.  Pages are yielded in ID order as soon as
+    they (and all the pages before them) arrive so callers can start work
+    before the last page has been fetched.
 
+    ONE cannot tell us the highest VM ID ahead of time so pages keep being
+    requested until max_workers consecutive pages come back empty, then
+    whatever remains is fetched with a single open ended range which
+    ensures VMs beyond a large gap in IDs are never missed.
+    :param include_done: include VMs in the DONE state
+    :param page_size: number of VM IDs covered by each page
+    :param max_workers: number of pages fetched concurrently
+    :return: generator of VirtualMachine objects in ID order
+    """
+    state = INCLUDING_DONE if include_done else EXCEPT_DONE
+    clusters = self._cluster_map()
+    pending = deque()
+    next_start = 0
+    consecutive_empty = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      for i in range(max_workers):
+        pending.append(executor.submit(self._get_vm_page, state, next_start, next_start + page_size - 1, clusters))
+        next_start += page_size
+      while pending:
+        vms = pending.popleft().result()
+        consecutive_empty = 0 if vms else consecutive_empty + 1
+        if consecutive_empty < max_workers:
+          pending.append(executor.submit(self._get_vm_page, state, next_start, next_start + page_size - 1, clusters))
+          next_start += page_size
+        for vm in vms:
+          yield vm
+    for vm in self._get_vm_page(state, next_start, UNLIMITED, clusters):
+      yield vm
 
-  def get_clusters(self):
+  def get_vm(self, id):
     """
-    Returns all the datastores in a given zone
+    Returns a VM in a given zone
+    :return:
+    """
+    clusters = self._cluster_map()
+    return self._info('one.vm.info', id, lambda response: _parse_vm(id, response, clusters))
+
+  def _get_vm_if_exists(self, id, clusters):
+    """
+    Returns a VM or None if it doesn't exist
+    :param id:
+    :param clusters: dict of cluster ID to Cluster
+    :return:
+    """
+    return self._info('one.vm.info', id, lambda response: _parse_vm(id, response, clusters, missing_ok=True))
+
+  def get_vms_by_id(self, vm_ids, max_workers=DEFAULT_LOOKUP_WORKERS):
+    """
+    Returns only the requested VMs, looked up with one.vm.info calls batched
+    into system.multicalls (or made concurrently if the zone doesn't support
+    them), much cheaper than a full vmpool.info dump when only a handful of
+    VMs in a large zone are needed
+    :param vm_ids:
+    :param max_workers: maximum number of concurrent one.vm.info calls when
+    the zone doesn't support system.multicall
+    :return: dict of VM ID to VirtualMachine, IDs that no longer exist are omitted
+    """
+    if not vm_ids:
+      return {}
+    clusters = self._cluster_map()
+    with self.batch(max_workers) as batch:
+      futures = [batch.get_vm(id, clusters, missing_ok=True) for id in vm_ids]
+    vms = [future.result() for future in futures]
+    return {vm.id: vm for vm in vms if vm is not None}
+
+  def get_clusters(self, refresh=False):
+    """
+    Returns all the clusters in a given zone, from the cluster cache when
+    there is one as they rarely change
+    :param refresh: discard the cached clusters and fetch them from ONE
     :return:
     """
+    if self.cluster_cache is None:
+      return self._fetch_clusters()
+    if refresh:
+      self.cluster_cache.invalidate(self.api_url)
+    return list(self.cluster_cache.get(self.api_url, lambda: tuple(self._fetch_clusters())))
+
+  def _fetch_clusters(self):
     response = self.proxy.one.clusterpool.info(self.session_string)
     if response[0] is not True:
       raise (Exception("one.clusterpool.info failed (error code: {}) {}".format(
@@ -213,6 +540,7 @@ class OneProxy:
         template))):
     """
     response = self.proxy.one.vm.allocate(self.session_string, template, hold)
+    self._changed()
     if response[0] is not True:
       raise (Exception("one.vm.allocate failed (error code: {}) {} with template {}".format(
         response[2],
@@ -226,46 +554,122 @@ class OneProxy:
 
   def kill_vm(self, vm_id):
     """
+    Kills a VM and waits for it to be DONE, see kill_vms
+    :param vm_id:
+    :raise DefiedDeathException: if the VM could not be killed
+    """
+    outcome = self.kill_vms([vm_id])[vm_id]
+    if not outcome.done:
+      raise OneProxy.DefiedDeathException(outcome.error)
 
-    :param vm: VirtualMachine
-    :return:
+  def _get_vm_states(self, vm_ids):
+    """
+    Returns the state ID of each of vm_ids that is not yet DONE with
+    one.vm.info calls for just those IDs, sent as a system.multicall, only
+    the STATE of each VM is read
+    :param vm_ids:
+    :return: dict of VM ID to state ID, VMs that are DONE or gone are omitted
+    """
+    states = {}
+    for id, response in zip(vm_ids, self.run_calls([('one.vm.info', (self.session_string, id)) for id in vm_ids])):
+      if isinstance(response, Exception):
+        raise response
+      if response[0] is not True:
+        if response[2] == NO_EXISTS:
+          continue
+        raise (Exception("one.vm.info id {} failed (error code: {}) {}".format(
+          id,
+          response[2],
+          response[1])))
+      state_id = int(etree.fromstring(response[1]).findtext('STATE'))
+      if state_id != DONE_STATE_ID:
+        states[id] = state_id
+    return states
+
+  def kill_vms(self, vm_ids, timeout_s=DEFAULT_KILL_TIMEOUT_S, poll_s=DEFAULT_KILL_POLL_S,
+               max_poll_s=DEFAULT_KILL_MAX_POLL_S, escalate_s=DEFAULT_KILL_ESCALATE_S):
     """
-    # Note these get popped off, so they are attempted in reverse order
-    pre_active_kill_cmds = ['delete', 'delete', 'cancel']
-    post_active_kill_cmds = ['cancel', 'shutdown-hard', 'shutdown']
-    attempted_cmds = []
+    Kills the VMs and waits for them to be DONE.  Each round issues the next
+    kill command to every VM still needing one, then the states of all the
+    VMs are checked with a single vmpool.info call.  Rounds are spaced with
+    exponential backoff so killing a whole batch costs a handful of calls
+    rather than two per VM per second.
+
+    Commands are escalated per VM when ONE rejects one, or when the VM still
+    isn't DONE escalate_s after ONE accepted it (e.g. a guest ignoring the
+    ACPI shutdown), the sequence depends on the VM's state (see
+    kill_cmds_for).  VMs that are STOPPED, SUSPENDED, FAILED, POWEROFF or
+    beyond are deleted, if ONE rejects that for those FAILED or beyond
+    they're counted as done like kill_vm always has.
+    :param vm_ids:
+    :param timeout_s: VMs not DONE after this long are reported as failed
+    :param poll_s: seconds before the first state check
+    :param max_poll_s: cap on the seconds between state checks
+    :param escalate_s: seconds to wait for an accepted command to take effect
+    :return: dict of VM ID to KillOutcome
+    """
+    outcomes = {id: KillOutcome(id) for id in vm_ids}
+    if not outcomes:
+      return outcomes
+    kill_cmds = {id: new_kill_cmds() for id in outcomes}
+    needs_action = set(outcomes)
+    escalate_at = {}
+    outstanding = set(outcomes)
+    deadline = time.monotonic() + timeout_s
+    states = self._get_vm_states(list(outstanding))
     while True:
-      # refresh our VM
-      vm = self.get_vm(id=vm_id)
-      if vm.state_id >= 6:
+      to_action = {}
+      for id in sorted(outstanding):
+        outcome = outcomes[id]
+        state_id = states.get(id)
+        if state_id is None:
+          outcome.done = True
+          outcome.state = 'DONE'
+          outcome.error = None
+          outstanding.discard(id)
+          continue
+        outcome.state = VirtualMachine.state_by_id(state_id)
+        cmds = kill_cmds_for(kill_cmds[id], state_id)
+        if id not in needs_action:
+          # the last command was accepted, give it time before escalating
+          if len(cmds) == 0 or time.monotonic() < escalate_at[id]:
+            continue
+          needs_action.add(id)
+        if len(cmds) == 0 and state_id >= FAILED_STATE_ID:
+          outcome.done = True
+          outcome.error = None
+          outstanding.discard(id)
+          continue
+        if len(cmds) == 0:
+          outcome.error = "No more attempts at killing VM in state {} left, tried: {}".format(
+            outcome.state, ", ".join(outcome.attempted_cmds))
+          outstanding.discard(id)
+          continue
+        cmd = cmds.pop()
+        outcome.attempted_cmds.append(cmd)
+        to_action.setdefault(cmd, []).append(id)
+      for cmd, ids in to_action.items():
+        try:
+          result = self.action_vms(cmd, ids)
+        except Exception as e:
+          result = BulkActionResult(cmd)
+          result.errors = {id: str(e) for id in ids}
+        needs_action.difference_update(result.succeeded)
+        for id in result.succeeded:
+          escalate_at[id] = time.monotonic() + escalate_s
+        for id, error in result.errors.items():
+          outcomes[id].error = error
+      if not outstanding:
+        break
+      if time.monotonic() + poll_s > deadline:
+        for id in outstanding:
+          outcomes[id].error = "VM still {} after {}s, tried: {}".format(
+            outcomes[id].state, timeout_s, ", ".join(outcomes[id].attempted_cmds))
         break
-      if vm.state_id < 3:
-        # The VM is not yet active..
-        if len(pre_active_kill_cmds) == 0:
-          raise Exception("No more attempts at killing VM in state {} left, tried: {}".format(
-            vm.state, ", ".join(attempted_cmds)))
-        else:
-          try:
-            cmd = pre_active_kill_cmds.pop()
-            attempted_cmds.append(cmd)
-            self.action_vm(action=cmd, vm_id=vm.id)
-            break
-          except Exception as e:
-            pass
-      else:
-        # The VM is active..
-        if len(post_active_kill_cmds) == 0:
-          raise Exception("No more attempts at killing VM in state {} left, tried: {}".format(
-            vm.state, ", ".join(attempted_cmds)))
-        else:
-          try:
-            cmd = pre_active_kill_cmds.pop()
-            attempted_cmds.append(cmd)
-            self.action_vm(action=cmd, vm_id=vm.id)
-            break
-          except Exception as e:
-            pass
-      time.sleep(1)
+      time.sleep(poll_s)
+      poll_s = min(poll_s * 2, max_poll_s)
+      states = self._get_vm_states(list(outstanding))
+    return outcomes
 
   def action_vm(self, action, vm_id):
     """
@@ -274,25 +678,49 @@ class OneProxy:
     :param vm_id:
     :return:
     """
-    if action not in ["shutdown",
-      "shutdown-hard",
-      "hold",
-      "release",
-      "stop",
-      "suspend",
-      "resume",
-      "boot",
-      "delete",
-      "delete-recreate",
-      "reboot",
-      "reboot-hard",
-      "resched",
-      "unresched",
-      "poweroff",
-      "poweroff-hard",
-      "undeploy",
-      "undeploy-hard"]:
+    if action not in VM_ACTIONS:
       raise Exception("Unknown action: {}".format(action))
+    try:
+      self._action_vm(action, vm_id)
+    finally:
+      self._changed()
+
+  def action_vms(self, action, vm_ids, max_parallel=DEFAULT_ACTION_WORKERS):
+    """
+    Performs an action on many VMs, making up to max_parallel calls at once.
+    A failure doesn't stop the action being attempted on the other VMs.
+    :param action:
+    :param vm_ids:
+    :param max_parallel:
+    :return: BulkActionResult
+    """
+    if action not in VM_ACTIONS:
+      raise Exception("Unknown action: {}".format(action))
+    result = BulkActionResult(action)
+    if not vm_ids:
+      return result
+    start = time.monotonic()
+
+    def attempt(vm_id):
+      try:
+        self._action_vm(action, vm_id)
+        return vm_id, None
+      except Exception as e:
+        return vm_id, str(e)
+
+    try:
+      with ThreadPoolExecutor(max_workers=min(max_parallel, len(vm_ids))) as executor:
+        for vm_id, error in executor.map(attempt, vm_ids):
+          if error is None:
+            result.succeeded.append(vm_id)
+          else:
+            result.errors[vm_id] = error
+    finally:
+      self._changed()
+    result.elapsed_s = time.monotonic() - start
+    return result
+
+  def _action_vm(self, action, vm_id):
     response = self.proxy.one.vm.action(self.session_string, action, vm_id)
     if response[0] is not True:
       raise (Exception("one.vm.action failed (error code: {}) {} action={}, vm_id={}".format(
@@ -0,0 +1,306 @@
+"""
+An asyncio counterpart to OneProxy for driving many concurrent VM operations
+from a single thread.  Calls to a zone share a small set of keep-alive
+connections and are limited by a per zone semaphore, so hundreds of
+operations across every zone can be in flight without a thread each.
+
+  async def main():
+    one_proxy = AsyncOneProxy(zone.xmlrpc_uri, zone.session_string)
+    vms = await asyncio.gather(*[one_proxy.get_vm(id) for id in vm_ids])
+"""
+import asyncio
+import weakref
+import xml.etree.ElementTree as etree
+import xmlrpc.client
+from urllib.parse import urlparse
+from lifeguard.one import CURRENT_USER, UNLIMITED, EXCEPT_DONE, INCLUDING_DONE, VM_ACTIONS, iter_vms_from_xml, \
+  _parse_vm, new_kill_cmds, kill_cmds_for, DONE_STATE_ID, FAILED_STATE_ID, DEFAULT_KILL_TIMEOUT_S, DEFAULT_KILL_POLL_S, \
+  DEFAULT_KILL_MAX_POLL_S, DEFAULT_KILL_ESCALATE_S
+from lifeguard.one.Cluster import Cluster
+from lifeguard.one.VirtualMachine import VirtualMachine
+from lifeguard.one.transport import new_ssl_context
+
+DEFAULT_ZONE_CONCURRENCY = 64
+
+# responses larger than this are parsed on the default executor so a big
+# vmpool.info doesn't stall every other call on the event loop
+PARSE_IN_EXECUTOR_BYTES = 256 * 1024
+
+
+class _AsyncZone:
+  """
+  The concurrency limit and idle keep-alive connections of one zone
+  endpoint within one event loop
+  """
+  def __init__(self, uri, verify_certs, max_concurrency):
+    url = urlparse(uri)
+    self.https = url.scheme == 'https'
+    self.host = url.hostname
+    self.port = url.port or (443 if self.https else 80)
+    self.path = url.path or '/RPC2'
+    self.ssl_context = new_ssl_context(verify_certs) if self.https else None
+    self.semaphore = asyncio.Semaphore(max_concurrency)
+    self.idle = []
+    self.max_concurrency = max_concurrency
+
+  async def _connect(self):
+    if self.idle:
+      return self.idle.pop()
+    return await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context,
+                                         server_hostname=self.host if self.https else None)
+
+  async def _read_response(self, reader):
+    status_line = await reader.readline()
+    if not status_line:
+      raise ConnectionResetError("connection closed by {}".format(self.host))
+    version, status = status_line.split()[:2]
+    status = int(status)
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      k, v = line.decode('latin-1').split(':', 1)
+      headers[k.strip().lower()] = v.strip()
+    if version == b'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive':
+      headers['connection'] = 'close'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+          await reader.readline()
+          break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+      body = b''.join(chunks)
+    elif 'content-length' in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      body = await reader.read()
+      headers['connection'] = 'close'
+    return status, headers, body
+
+  async def call(self, method, params):
+    """
+    Makes an XML-RPC call
+    :param method: e.g. one.vm.info
+    :param params: tuple of arguments
+    :return: the body of the response
+    """
+    request_body = xmlrpc.client.dumps(params, method).encode('utf-8')
+    request = (
+      "POST {} HTTP/1.1\r\n"
+      "Host: {}:{}\r\n"
+      "User-Agent: lifeguard\r\n"
+      "Content-Type: text/xml\r\n"
+      "Content-Length: {}\r\n\r\n".format(self.path, self.host, self.port, len(request_body))
+    ).encode('latin-1') + request_body
+    async with self.semaphore:
+      # retry once if an idle connection has been closed by the other end
+      for attempt in (0, 1):
+        reused = bool(self.idle)
+        reader, writer = await self._connect()
+        try:
+          writer.write(request)
+          await writer.drain()
+          status, headers, body = await self._read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+          writer.close()
+          if attempt or not reused:
+            raise
+          continue
+        except BaseException:
+          writer.close()
+          raise
+        if headers.get('connection', '').lower() == 'close' or len(self.idle) >= self.max_concurrency:
+          writer.close()
+        else:
+          self.idle.append((reader, writer))
+        if status != 200:
+          raise xmlrpc.client.ProtocolError(self.host + self.path, status, body.decode('utf-8', 'replace'), headers)
+        return body
+
+
+_zones = weakref.WeakKeyDictionary()
+
+
+def _zone(uri, verify_certs, max_concurrency):
+  """
+  Returns the _AsyncZone for uri in the running event loop, asyncio
+  primitives can't be shared between loops
+  """
+  zones = _zones.setdefault(asyncio.get_event_loop(), {})
+  zone = zones.get((uri, verify_certs))
+  if zone is None:
+    zone = _AsyncZone(uri, verify_certs, max_concurrency)
+    zones[(uri, verify_certs)] = zone
+  return zone
+
+
+class AsyncOneProxy:
+  def __init__(self, api_url, session_string, verify_certs=True, on_change=None,
+               max_concurrency=DEFAULT_ZONE_CONCURRENCY):
+    """
+    :param api_url:
+    :param session_string:
+    :param verify_certs:
+    :param on_change: optional callable invoked after VMs are created or
+    actioned, used to invalidate anything caching the zone's VMs
+    :param max_concurrency: maximum calls in flight to the zone, shared by
+    every AsyncOneProxy for the same api_url (the first one sets it)
+    """
+    self.api_url = api_url
+    self.session_string = session_string
+    self.verify_certs = verify_certs
+    self.on_change = on_change
+    self.max_concurrency = max_concurrency
+
+  def _changed(self):
+    if self.on_change is not None:
+      self.on_change()
+
+  async def _call(self, method, *params):
+    zone = _zone(self.api_url, self.verify_certs, self.max_concurrency)
+    body = await zone.call(method, (self.session_string,) + params)
+    return await self._parse(len(body), xmlrpc.client.loads, body)
+
+  async def _parse(self, size, f, *args):
+    """
+    Runs the parser f(*args) inline, or on the default executor when size
+    (in bytes) is large enough that it would hold up other calls
+    """
+    if size > PARSE_IN_EXECUTOR_BYTES:
+      return await asyncio.get_event_loop().run_in_executor(None, f, *args)
+    return f(*args)
+
+  async def _call_checked(self, method, *params):
+    response = (await self._call(method, *params))[0][0]
+    if response[0] is not True:
+      raise (Exception("{} failed (error code: {}) {}".format(
+        method,
+        response[2],
+        response[1])))
+    return response
+
+  async def get_clusters(self):
+    """
+    Returns all the clusters in a given zone
+    :return:
+    """
+    response = await self._call_checked('one.clusterpool.info')
+    items = [Cluster.from_xml_etree(child) for child in etree.fromstring(response[1])]
+    items.sort(key=lambda x: x.name)
+    return items
+
+  async def _cluster_map(self):
+    return {cluster.id: cluster for cluster in await self.get_clusters()}
+
+  async def get_vms(self, include_done=False):
+    """
+    Returns all VMs in a given zone, the clusters are fetched alongside
+    :param include_done: include VMs in the DONE state
+    :return:
+    """
+    state = INCLUDING_DONE if include_done else EXCEPT_DONE
+    response, clusters = await asyncio.gather(
+      self._call_checked('one.vmpool.info', CURRENT_USER, UNLIMITED, UNLIMITED, state),
+      self._cluster_map())
+    items = await self._parse(len(response[1]), lambda: list(iter_vms_from_xml(response[1], clusters)))
+    items.sort(key=lambda x: x.name)
+    return items
+
+  async def get_vm(self, id, clusters=None, missing_ok=False):
+    """
+    Returns a VM in a given zone
+    :param id:
+    :param clusters: dict of cluster ID to Cluster, fetched if not given
+    :param missing_ok: return None rather than raise if the VM doesn't exist
+    :return:
+    """
+    if clusters is None:
+      response, clusters = await asyncio.gather(self._call('one.vm.info', id), self._cluster_map())
+    else:
+      response = await self._call('one.vm.info', id)
+    return _parse_vm(id, response[0][0], clusters, missing_ok)
+
+  async def create_vm(self, template, hold=False):
+    """
+    Create a virtual machine defined by the template
+    set hold=True to hold the VM after creation, hold=false to make it pending (launch)
+    :param template:
+    :param hold:
+    :return: the ID of the new VM
+    """
+    response = (await self._call('one.vm.allocate', template, hold))[0][0]
+    self._changed()
+    if response[0] is not True:
+      raise (Exception("one.vm.allocate failed (error code: {}) {} with template {}".format(
+        response[2],
+        response[1],
+        template)))
+    return response[1]
+
+  async def action_vm(self, action, vm_id):
+    """
+    Performs an action on a VM
+    :param action:
+    :param vm_id:
+    :return:
+    """
+    if action not in VM_ACTIONS:
+      raise Exception("Unknown action: {}".format(action))
+    response = (await self._call('one.vm.action', action, vm_id))[0][0]
+    self._changed()
+    if response[0] is not True:
+      raise (Exception("one.vm.action failed (error code: {}) {} action={}, vm_id={}".format(
+        response[2],
+        response[1],
+        action,
+        vm_id)))
+
+  async def kill_vm(self, vm_id, clusters=None, timeout_s=DEFAULT_KILL_TIMEOUT_S, poll_s=DEFAULT_KILL_POLL_S,
+                    max_poll_s=DEFAULT_KILL_MAX_POLL_S, escalate_s=DEFAULT_KILL_ESCALATE_S):
+    """
+    Kills a VM and waits for it to be DONE, escalating through the same kill
+    commands as OneProxy.kill_vms (see kill_cmds_for) and sleeping without
+    blocking the event loop
+    :param vm_id:
+    :param clusters: dict of cluster ID to Cluster, fetched if not given
+    :param timeout_s:
+    :param poll_s: seconds before the first state check, doubled after each
+    :param max_poll_s:
+    :param escalate_s: seconds to wait for an accepted command to take effect
+    :raise Exception: if the VM could not be killed
+    """
+    if clusters is None:
+      clusters = await self._cluster_map()
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout_s
+    kill_cmds = new_kill_cmds()
+    attempted_cmds = []
+    escalate_at = None
+    while True:
+      vm = await self.get_vm(vm_id, clusters, missing_ok=True)
+      # gone altogether counts as DONE, as it does for kill_vms
+      if vm is None or vm.state_id == DONE_STATE_ID:
+        return
+      cmds = kill_cmds_for(kill_cmds, vm.state_id)
+      if escalate_at is None or (len(cmds) > 0 and loop.time() >= escalate_at):
+        if len(cmds) == 0 and vm.state_id >= FAILED_STATE_ID:
+          # counted as done like kill_vm always has
+          return
+        if len(cmds) == 0:
+          raise Exception("No more attempts at killing VM in state {} left, tried: {}".format(
+            vm.state, ", ".join(attempted_cmds)))
+        cmd = cmds.pop()
+        attempted_cmds.append(cmd)
+        try:
+          await self.action_vm(action=cmd, vm_id=vm.id)
+          escalate_at = loop.time() + escalate_s
+        except Exception as e:
+          escalate_at = None
+      if loop.time() + poll_s > deadline:
+        raise Exception("VM still {} after {}s, tried: {}".format(vm.state, timeout_s, ", ".join(attempted_cmds)))
+      await asyncio.sleep(poll_s)
+      poll_s = min(poll_s * 2, max_poll_s)
@@ -0,0 +1,194 @@
+"""
+Batching of XML-RPC calls into system.multicall requests so many lookups
+share a single round trip.  Calls are either collected explicitly (CallBatch,
+see OneProxy.batch) or from any thread within a short window
+(WindowBatcher).  Endpoints that don't support system.multicall are
+detected on first use and the calls are made concurrently instead.
+"""
+import logging
+import threading
+import xmlrpc.client
+from concurrent.futures import Future, ThreadPoolExecutor
+
+MULTICALL_MAX_CALLS = 100
+DEFAULT_FALLBACK_WORKERS = 8
+
+
+def resolve(proxy, method):
+  """
+  :return: the callable for a dotted method name, e.g. one.vm.info
+  """
+  for name in method.split('.'):
+    proxy = getattr(proxy, name)
+  return proxy
+
+
+def _call_or_exception(proxy, method, params):
+  try:
+    return resolve(proxy, method)(*params)
+  except Exception as e:
+    return e
+
+
+def run_calls(proxy, pool, calls, max_calls=MULTICALL_MAX_CALLS, max_workers=DEFAULT_FALLBACK_WORKERS):
+  """
+  Makes the calls in multicalls of up to max_calls each, or concurrently one
+  by one if the endpoint doesn't support system.multicall
+  :param proxy: a PooledServerProxy
+  :param pool: the ConnectionPool behind it, remembers whether multicall works
+  :param calls: list of (method, params) tuples
+  :return: list with the result of each call, or the exception it raised
+  """
+  results = []
+  if pool.multicall_supported and len(calls) > 1:
+    for start in range(0, len(calls), max_calls):
+      chunk = calls[start:start + max_calls]
+      try:
+        responses = proxy.system.multicall([{'methodName': method, 'params': list(params)}
+                                            for method, params in chunk])
+      except xmlrpc.client.Fault as e:
+        if results:
+          raise
+        logging.warning("system.multicall not supported by {}, making calls individually: {}".format(pool.uri, e))
+        pool.multicall_supported = False
+        break
+      pool._count('multicalls')
+      pool._count('batched_calls', len(chunk))
+      for response in responses:
+        if isinstance(response, dict):
+          results.append(xmlrpc.client.Fault(response['faultCode'], response['faultString']))
+        else:
+          results.append(response[0])
+    if len(results) == len(calls):
+      return results
+  if len(calls) == 1:
+    return [_call_or_exception(proxy, *calls[0])]
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+    return list(executor.map(lambda call: _call_or_exception(proxy, *call), calls))
+
+
+def _settle(future, result, parse):
+  if isinstance(result, Exception):
+    future.set_exception(result)
+    return
+  try:
+    future.set_result(result if parse is None else parse(result))
+  except Exception as e:
+    future.set_exception(e)
+
+
+class CallBatch:
+  """
+  Collects calls until flush() (or the end of the with block) sends them
+  together, each call returns a Future of its result
+  """
+  def __init__(self, run):
+    """
+    :param run: callable taking a list of (method, params) returning their results
+    """
+    self.run = run
+    self._calls = []
+
+  def call(self, method, params, parse=None):
+    """
+    :param method:
+    :param params: tuple of arguments
+    :param parse: optional callable applied to the result
+    :return: Future
+    """
+    future = Future()
+    self._calls.append((method, params, parse, future))
+    return future
+
+  def flush(self):
+    calls, self._calls = self._calls, []
+    if not calls:
+      return
+    try:
+      results = self.run([(method, params) for method, params, parse, future in calls])
+    except Exception as e:
+      results = [e] * len(calls)
+    for (method, params, parse, future), result in zip(calls, results):
+      _settle(future, result, parse)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is None:
+      self.flush()
+    else:
+      for method, params, parse, future in self._calls:
+        future.cancel()
+      self._calls = []
+
+
+class WindowBatcher:
+  """
+  Thread safe batcher that holds each call for up to window_s seconds so
+  that calls made from other threads in the meantime share its multicall,
+  a batch is sent as soon as it holds max_calls.  Every call waits out the
+  window, so this only pays off with many threads making lookups at once
+  (see bench_window).
+  """
+  def __init__(self, run, window_s, max_calls=MULTICALL_MAX_CALLS):
+    self.run = run
+    self.window_s = window_s
+    self.max_calls = max_calls
+    self._lock = threading.Lock()
+    self._batch = None
+    self._timer = None
+
+  def submit(self, method, params, parse=None):
+    """
+    :return: Future of the call's (parsed) result
+    """
+    full = None
+    with self._lock:
+      if self._batch is None:
+        self._batch = CallBatch(self.run)
+        self._timer = threading.Timer(self.window_s, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+      future = self._batch.call(method, params, parse)
+      if len(self._batch._calls) >= self.max_calls:
+        full = self._take()
+    if full is not None:
+      full.flush()
+    return future
+
+  def _take(self):
+    batch, self._batch = self._batch, None
+    self._timer.cancel()
+    self._timer = None
+    return batch
+
+  def flush(self):
+    with self._lock:
+      batch = self._take() if self._batch is not None else None
+    if batch is not None:
+      batch.flush()
+
+
+_window_batchers = {}
+_window_batchers_lock = threading.Lock()
+
+
+def get_window_batcher(pool, session_string, window_s, run):
+  """
+  Returns the process wide WindowBatcher for the pool and session so that
+  calls from every proxy for the zone using the same credentials share
+  multicalls, creating it on first use
+  :param pool: ConnectionPool
+  :param session_string: the batched calls are made with, run must use it too
+  :param window_s:
+  :param run: callable taking a list of (method, params) returning their results
+  :return: WindowBatcher
+  """
+  key = (pool, session_string, window_s)
+  with _window_batchers_lock:
+    batcher = _window_batchers.get(key)
+    if batcher is None:
+      batcher = WindowBatcher(run, window_s)
+      _window_batchers[key] = batcher
+    return batcher
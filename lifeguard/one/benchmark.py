@@ -0,0 +1,328 @@
+"""
+Benchmarks for the ONE client helpers that run against synthetic payloads
+so they can be used without access to a zone:
+
+  python -m lifeguard.one.benchmark
+"""
+import asyncio
+import gc
+import io
+import time
+import tracemalloc
+import xml.etree.ElementTree as etree
+from concurrent.futures import ThreadPoolExecutor
+from lifeguard.one import OneProxy, iter_vms_from_xml
+from lifeguard.one.VirtualMachine import VirtualMachine, STATE_BY_ID, LCM_STATE_BY_ID
+from lifeguard.one.aio import AsyncOneProxy
+from lifeguard.one.cache import TtlCache
+from lifeguard.one.stub import StubOneServer, synthetic_vmpool_xml
+
+
+def parse_dom(xml):
+  return [VirtualMachine.from_xml_etree(child) for child in etree.fromstring(xml)]
+
+
+def parse_streaming(xml):
+  return list(iter_vms_from_xml(xml))
+
+
+def measure(f, *args):
+  """
+  Runs f(*args) returning the elapsed seconds and the peak number of bytes
+  allocated while it ran.  tracemalloc is used rather than the process RSS
+  so that each measurement is isolated from the ones that ran before it.
+  :return: result, elapsed seconds, peak bytes
+  """
+  gc.collect()
+  tracemalloc.start()
+  start = time.perf_counter()
+  result = f(*args)
+  elapsed = time.perf_counter() - start
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, elapsed, peak
+
+
+def bench_vmpool_parse(sizes=(1000, 10000, 50000)):
+  print("{:>8} {:>10} {:>10} {:>12} {:>12}".format("vms", "parser", "seconds", "peak MiB", "MiB/1k vms"))
+  for size in sizes:
+    xml = synthetic_vmpool_xml(size)
+    for name, parser in [('dom', parse_dom), ('iterparse', parse_streaming)]:
+      vms, elapsed, peak = measure(parser, xml)
+      if len(vms) != size:
+        raise Exception("{} parser returned {} of {} VMs".format(name, len(vms), size))
+      del vms
+      print("{:>8} {:>10} {:>10.3f} {:>12.1f} {:>12.2f}".format(
+        size, name, elapsed, peak / 2 ** 20, peak / 2 ** 20 / (size / 1000)))
+
+
+class _DictVirtualMachine:
+  """
+  The dict backed VirtualMachine and its find() per attribute parsing as they
+  were before being reworked, kept as the baseline for the benchmarks
+  """
+  def __init__(self, etree):
+    self.id = int(etree.find('ID').text)
+    self.name = etree.find('NAME').text
+    self.state = _DictVirtualMachine.state_by_id(int(etree.find('STATE').text))
+    self.state_id = int(etree.find('STATE').text)
+    self.lcm_state = _DictVirtualMachine.lcm_state_by_id(int(etree.find('LCM_STATE').text))
+    self.lcm_state_id = int(etree.find('LCM_STATE').text)
+    self.stime = int(etree.find('STIME').text)
+    self.memory = int(etree.find('TEMPLATE').find('MEMORY').text)
+    self.cpu = float(etree.find('TEMPLATE').find('CPU').text)
+    self.vcpu = self.disk_cluster = self.disk_cluster_id = self.disk_datastore_id = None
+    self.disk_datastore_name = self.image_name = self.image_id = self.ip_address = self.template_id = None
+    if etree.find('TEMPLATE').find('TEMPLATE_ID') is not None:
+      self.template_id = int(etree.find('TEMPLATE').find('TEMPLATE_ID').text)
+    if etree.find('TEMPLATE').find('DISK') is not None:
+      self.disk_cluster_id = int(etree.find('TEMPLATE').find('DISK').find('CLUSTER_ID').text)
+      self.disk_datastore_id = int(etree.find('TEMPLATE').find('DISK').find('DATASTORE_ID').text)
+      self.disk_datastore_name = etree.find('TEMPLATE').find('DISK').find('DATASTORE').text
+      self.image_name = etree.find('TEMPLATE').find('DISK').find('IMAGE').text
+      self.image_id = int(etree.find('TEMPLATE').find('DISK').find('IMAGE_ID').text)
+    if etree.find('TEMPLATE').find('NIC') is not None:
+      self.ip_address = etree.find('TEMPLATE').find('NIC').find('IP').text
+    if etree.find('TEMPLATE').find('VCPU') is not None:
+      self.vcpu = float(etree.find('TEMPLATE').find('VCPU').text)
+
+  @staticmethod
+  def state_by_id(id):
+    # the table used to be rebuilt on every call
+    return dict(STATE_BY_ID)[id]
+
+  @staticmethod
+  def lcm_state_by_id(id):
+    return dict(LCM_STATE_BY_ID)[id]
+
+
+def bench_vm_parse_cost(num_vms=1000, repeat=5, max_us_per_vm=None):
+  """
+  Micro-benchmark of the cost of building a VirtualMachine from an already
+  parsed <VM> element, alongside the original find() per attribute parsing.
+  Pass max_us_per_vm to turn it into a regression check.
+  :param num_vms: number of <VM> elements built per round
+  :param repeat: number of rounds, the fastest is reported
+  :param max_us_per_vm: raise if from_xml_etree costs more than this
+  :return: microseconds per VM for from_xml_etree
+  """
+  elements = list(etree.fromstring(synthetic_vmpool_xml(num_vms)))
+  clusters = {i: None for i in range(4)}
+  results = {}
+  for name, build in [('original', _DictVirtualMachine),
+                      ('from_xml_etree', lambda el: VirtualMachine.from_xml_etree(el, clusters))]:
+    best = None
+    for i in range(repeat):
+      start = time.perf_counter()
+      for el in elements:
+        build(el)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+    results[name] = best / num_vms * 1e6
+    print("{:>16} {:>8.2f} us/vm".format(name, results[name]))
+  if max_us_per_vm is not None and results['from_xml_etree'] > max_us_per_vm:
+    raise Exception("from_xml_etree took {:.2f}us per VM, budget is {:.2f}us".format(
+      results['from_xml_etree'], max_us_per_vm))
+  return results['from_xml_etree']
+
+
+def retained_bytes(f, *args):
+  """
+  :return: result of f(*args) and the number of bytes it still holds on to
+  """
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  result = f(*args)
+  gc.collect()
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return result, after - before
+
+
+def bench_vm_memory(num_vms=50000):
+  """
+  Reports the bytes retained per VM for a zone of num_vms VMs with the old
+  dict backed representation and the slotted VirtualMachine
+  :param num_vms:
+  :return:
+  """
+  xml = synthetic_vmpool_xml(num_vms)
+
+  def build_dict_backed():
+    vms = []
+    for event, el in etree.iterparse(io.StringIO(xml)):
+      if el.tag == 'VM':
+        vms.append(_DictVirtualMachine(el))
+        el.clear()
+    return vms
+
+  print("{:>8} {:>14} {:>12} {:>10}".format("vms", "representation", "total MiB", "bytes/vm"))
+  for name, builder in [('dict', build_dict_backed), ('slotted', lambda: parse_streaming(xml))]:
+    vms, retained = retained_bytes(builder)
+    print("{:>8} {:>14} {:>12.1f} {:>10.0f}".format(num_vms, name, retained / 2 ** 20, retained / len(vms)))
+    del vms
+
+
+def timed(f, *args, **kwargs):
+  start = time.perf_counter()
+  f(*args, **kwargs)
+  return time.perf_counter() - start
+
+
+def bench_lookup_strategy(zone_size=5000, fractions=(0.01, 0.1, 0.25, 0.5, 0.75, 1.0), latency_s=0.005,
+                          page_size=1000):
+  """
+  Compares looking up a pool's members the way lookup_vms does, with
+  get_vms_by_id (one.vm.info batched into multicalls), against loading the
+  zone's inventory with a paged vmpool.info dump, to find the share of the
+  zone a pool must be before the dump is cheaper.  With the stub the dump
+  only wins once a pool is roughly three quarters of its zone, which is why
+  lookup_vms always makes targeted lookups.
+  :param zone_size: number of VMs in the zone
+  :param fractions: of the zone to look up
+  :param latency_s: simulated round trip time of each call to oned
+  :param page_size: as ONE_VMPOOL_PAGE_SIZE
+  :return: the smallest fraction where the dump won, None if it never did
+  """
+  crossover = None
+  with StubOneServer(num_vms=zone_size, latency_s=latency_s) as server:
+    one_proxy = OneProxy(server.url, 'session', cluster_cache=TtlCache(3600))
+    bulk = timed(lambda: {vm.id: vm for vm in one_proxy.iter_vms(include_done=True, page_size=page_size)})
+    print("zone of {} VMs, {:.0f}ms simulated latency, paged vmpool.info: {:.3f}s".format(
+      zone_size, latency_s * 1000, bulk))
+    print("{:>8} {:>10} {:>10}".format("members", "targeted", "bulk"))
+    for fraction in fractions:
+      pool_size = max(1, int(zone_size * fraction))
+      vm_ids = list(range(0, zone_size, max(1, zone_size // pool_size)))[:pool_size]
+      targeted = timed(one_proxy.get_vms_by_id, vm_ids)
+      print("{:>8} {:>10.3f} {:>10.3f}".format(pool_size, targeted, bulk))
+      if crossover is None and targeted > bulk:
+        crossover = fraction
+  print("the dump becomes cheaper at {:.0%} of the zone".format(crossover) if crossover else "targeted lookups always won")
+  return crossover
+
+
+def bench_connection_reuse(num_vms=200, latency_s=0.0, max_workers=1):
+  """
+  Looks up num_vms VMs with targeted calls through the shared keep-alive
+  connection pool and again with a new connection per call (as every
+  ServerProxy used to), reporting the connections each had to open
+  :param num_vms:
+  :param latency_s: simulated round trip time of each call to oned
+  :param max_workers: number of concurrent one.vm.info calls
+  :return: the keep-alive pool's stats
+  """
+  # without system.multicall so every lookup is its own request
+  print("{:>12} {:>10} {:>8} {:>8} {:>20}".format("connections", "seconds", "opened", "reuses", "handshakes avoided"))
+  for name, max_idle in [('per call', 0), ('keep-alive', None)]:
+    with StubOneServer(num_vms=num_vms, latency_s=latency_s, multicall=False) as server:
+      one_proxy = OneProxy(server.url, 'session')
+      if max_idle is not None:
+        one_proxy.connection_pool.max_idle = max_idle
+      elapsed = timed(one_proxy.get_vms_by_id, list(range(num_vms)), max_workers)
+      stats = one_proxy.connection_pool.stats()
+      one_proxy.connection_pool.close()
+    print("{:>12} {:>10.3f} {:>8} {:>8} {:>20}".format(
+      name, elapsed, stats['connections_opened'], stats['reuses'], stats['handshakes_avoided']))
+  return stats
+
+
+def bench_async_fanout(num_vms=500, latency_s=0.02, num_threads=8, max_concurrency=64):
+  """
+  Fetches num_vms VMs individually with OneProxy on num_threads threads
+  (the way the workers sized by NUM_HEALTH_CHECK_THREADS do) and with
+  AsyncOneProxy limited to max_concurrency calls in flight on one thread
+  :param num_vms:
+  :param latency_s: simulated round trip time of each call to oned
+  :param num_threads:
+  :param max_concurrency:
+  :return: seconds taken by the threaded and the asyncio clients
+  """
+  vm_ids = list(range(num_vms))
+  with StubOneServer(num_vms=num_vms, latency_s=latency_s, multicall=False) as server:
+    threaded = timed(OneProxy(server.url, 'session').get_vms_by_id, vm_ids, num_threads)
+
+    async def fan_out():
+      one_proxy = AsyncOneProxy(server.url, 'session', max_concurrency=max_concurrency)
+      clusters = {cluster.id: cluster for cluster in await one_proxy.get_clusters()}
+      vms = await asyncio.gather(*[one_proxy.get_vm(id, clusters) for id in vm_ids])
+      if len(vms) != num_vms:
+        raise Exception("asyncio client returned {} of {} VMs".format(len(vms), num_vms))
+
+    loop = asyncio.new_event_loop()
+    try:
+      asyncio_elapsed = timed(loop.run_until_complete, fan_out())
+    finally:
+      loop.close()
+  print("{} one.vm.info calls, {:.0f}ms simulated latency".format(num_vms, latency_s * 1000))
+  print("{:>24} {:>10.3f}s".format("{} threads".format(num_threads), threaded))
+  print("{:>24} {:>10.3f}s".format("asyncio, {} in flight".format(max_concurrency), asyncio_elapsed))
+  return threaded, asyncio_elapsed
+
+
+def bench_multicall(num_vms=500, latency_s=0.02, num_threads=8):
+  """
+  Fetches num_vms VMs with one.vm.info calls batched into system.multicalls
+  and concurrently on num_threads threads against an endpoint without
+  multicall
+  :param num_vms:
+  :param latency_s: simulated round trip time of each request to oned
+  :param num_threads:
+  :return: seconds taken by the multicall and concurrent lookups
+  """
+  vm_ids = list(range(num_vms))
+  with StubOneServer(num_vms=num_vms, latency_s=latency_s) as server:
+    one_proxy = OneProxy(server.url, 'session')
+    multicall = timed(one_proxy.get_vms_by_id, vm_ids)
+    multicalls = one_proxy.connection_pool.stats()['multicalls']
+  with StubOneServer(num_vms=num_vms, latency_s=latency_s, multicall=False) as server:
+    concurrent = timed(OneProxy(server.url, 'session').get_vms_by_id, vm_ids, num_threads)
+  print("{} one.vm.info calls, {:.0f}ms simulated latency".format(num_vms, latency_s * 1000))
+  print("{:>32} {:>10.3f}s".format("multicall ({} requests)".format(multicalls), multicall))
+  print("{:>32} {:>10.3f}s".format("{} threads, no multicall".format(num_threads), concurrent))
+  return multicall, concurrent
+
+
+def bench_window(num_vms=500, latency_s=0.02, thread_counts=(8, 32, 64), window_s=0.001):
+  """
+  Fetches num_vms VMs from each of thread_counts threads calling get_vm one
+  VM at a time, as is and through the window batcher (ONE_BATCH_WINDOW_S)
+  :param num_vms:
+  :param latency_s: simulated round trip time of each request to oned
+  :param thread_counts:
+  :param window_s: how long the window batcher holds a call for
+  :return: dict of thread count to seconds taken as is and windowed
+  """
+  results = {}
+  vm_ids = list(range(num_vms))
+  print("{} get_vm calls, {:.0f}ms simulated latency, {:.0f}ms window".format(
+    num_vms, latency_s * 1000, window_s * 1000))
+  print("{:>8} {:>10} {:>10}".format("threads", "as is", "windowed"))
+  with StubOneServer(num_vms=num_vms, latency_s=latency_s) as server:
+    for num_threads in thread_counts:
+      elapsed = []
+      # get_vm looks the clusters up on every call unless they're cached
+      for proxy in [OneProxy(server.url, 'session', cluster_cache=TtlCache(3600)),
+                    OneProxy(server.url, 'session-{}'.format(num_threads), cluster_cache=TtlCache(3600),
+                             batch_window_s=window_s)]:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+          elapsed.append(timed(lambda: list(executor.map(proxy.get_vm, vm_ids))))
+      results[num_threads] = tuple(elapsed)
+      print("{:>8} {:>10.3f} {:>10.3f}".format(num_threads, *elapsed))
+  return results
+
+
+def run():
+  bench_vm_parse_cost()
+  bench_vmpool_parse()
+  bench_vm_memory()
+  bench_lookup_strategy()
+  bench_connection_reuse()
+  bench_async_fanout()
+  bench_multicall()
+  bench_window()
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,142 @@
+import threading
+import time
+import logging
+
+
+class TtlCache:
+  """
+  A thread safe, process wide cache of values that expire ttl_seconds after
+  they were loaded.  Concurrent misses on the same key wait for a single load
+  instead of each hitting ONE.  Hits, misses and invalidations are counted per
+  key so the TTL can be tuned from the stats.
+  """
+
+  def __init__(self, ttl_seconds, name='cache'):
+    """
+    :param ttl_seconds: seconds a loaded value is served before it is reloaded
+    :param name: used when logging
+    """
+    self.ttl_seconds = ttl_seconds
+    self.name = name
+    self._lock = threading.Lock()
+    self._key_locks = {}
+    self._entries = {}
+    self._counters = {}
+    # bumped by invalidate() so a load in flight at the time isn't cached
+    self._epoch = 0
+    self._generations = {}
+
+  def _count(self, key, counter):
+    with self._lock:
+      counters = self._counters.setdefault(key, {'hits': 0, 'misses': 0, 'invalidations': 0})
+      counters[counter] += 1
+
+  def _generation(self, key):
+    with self._lock:
+      return self._epoch, self._generations.get(key, 0)
+
+  def _fresh(self, key):
+    entry = self._entries.get(key)
+    if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+      return entry
+    return None
+
+  def get(self, key, loader):
+    """
+    Returns the cached value for key, calling loader() to (re)load it if it
+    is missing or has expired
+    :param key:
+    :param loader: callable that returns the value to cache
+    :return:
+    """
+    entry = self._fresh(key)
+    if entry is None:
+      with self._lock:
+        key_lock = self._key_locks.setdefault(key, threading.Lock())
+      with key_lock:
+        # another thread may have loaded it while we were waiting
+        entry = self._fresh(key)
+        if entry is None:
+          self._count(key, 'misses')
+          generation = self._generation(key)
+          entry = (time.monotonic(), loader())
+          with self._lock:
+            # invalidated while loading, the value may predate the change
+            stale = (self._epoch, self._generations.get(key, 0)) != generation
+            if not stale:
+              self._entries[key] = entry
+          if stale:
+            logging.info("{} invalidated while loading {}, not caching it".format(self.name, key))
+          else:
+            logging.info("{} miss for {}, loaded {}".format(self.name, key, self.stats(key)))
+          return entry[1]
+    self._count(key, 'hits')
+    return entry[1]
+
+  def peek(self, key):
+    """
+    Returns the cached value for key without ever loading it
+    :param key:
+    :return: the value or None if it is missing or has expired
+    """
+    entry = self._fresh(key)
+    if entry is None:
+      return None
+    self._count(key, 'hits')
+    return entry[1]
+
+  def put(self, key, value):
+    """
+    Caches value for key as if it had just been loaded
+    :param key:
+    :param value:
+    :return:
+    """
+    with self._lock:
+      self._entries[key] = (time.monotonic(), value)
+
+  def invalidate(self, key=None):
+    """
+    Drops the cached value for key (or every key if None) so the next get() reloads it
+    :param key:
+    :return:
+    """
+    with self._lock:
+      if key is None:
+        self._epoch += 1
+      else:
+        self._generations[key] = self._generations.get(key, 0) + 1
+      keys = list(self._entries) if key is None else [key]
+      for k in keys:
+        if self._entries.pop(k, None) is not None:
+          counters = self._counters.setdefault(k, {'hits': 0, 'misses': 0, 'invalidations': 0})
+          counters['invalidations'] += 1
+
+  def age(self, key):
+    """
+    :param key:
+    :return: seconds since the value for key was loaded, None if not cached
+    """
+    entry = self._entries.get(key)
+    return None if entry is None else time.monotonic() - entry[0]
+
+  def fresh_age(self, key):
+    """
+    Like age but without counting a hit for or loading the value
+    :param key:
+    :return: seconds since the value for key was loaded, None if it is
+    missing or has expired
+    """
+    entry = self._fresh(key)
+    return None if entry is None else time.monotonic() - entry[0]
+
+  def stats(self, key=None):
+    """
+    :param key: stats for a single key, or all keys if None
+    :return: dict of hits, misses, invalidations and age_seconds
+    """
+    if key is not None:
+      counters = dict(self._counters.get(key, {'hits': 0, 'misses': 0, 'invalidations': 0}))
+      counters['age_seconds'] = self.age(key)
+      return counters
+    return {k: self.stats(k) for k in list(self._counters)}
@@ -0,0 +1,191 @@
+"""
+A local stand in for a ONE zone's XML-RPC endpoint serving synthetic VMs, used
+by the benchmarks to exercise OneProxy over real HTTP without a zone.  Every
+request sleeps for latency_s to simulate the round trip to oned, so a
+system.multicall pays it once for all of its calls.
+"""
+import threading
+import time
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from lifeguard.one import NO_EXISTS, UNLIMITED, EXCEPT_DONE
+
+
+VM_XML = """<VM>
+  <ID>{id}</ID>
+  <UID>0</UID>
+  <GID>0</GID>
+  <UNAME>oneadmin</UNAME>
+  <GNAME>oneadmin</GNAME>
+  <NAME>pool{id}.sub.domain.tld</NAME>
+  <PERMISSIONS><OWNER_U>1</OWNER_U><OWNER_M>1</OWNER_M><OWNER_A>0</OWNER_A></PERMISSIONS>
+  <LAST_POLL>1466000000</LAST_POLL>
+  <STATE>{state}</STATE>
+  <LCM_STATE>{lcm_state}</LCM_STATE>
+  <RESCHED>0</RESCHED>
+  <STIME>1466000000</STIME>
+  <ETIME>0</ETIME>
+  <DEPLOY_ID>one-{id}</DEPLOY_ID>
+  <MEMORY>2097152</MEMORY>
+  <CPU>12</CPU>
+  <NET_TX>123456</NET_TX>
+  <NET_RX>654321</NET_RX>
+  <TEMPLATE>
+    <CONTEXT><HOSTNAME>pool{id}.sub.domain.tld</HOSTNAME><NETWORK>YES</NETWORK></CONTEXT>
+    <CPU>0.25</CPU>
+    <DISK>
+      <CLUSTER_ID>{cluster_id}</CLUSTER_ID>
+      <DATASTORE>datastore-{cluster_id}</DATASTORE>
+      <DATASTORE_ID>1{cluster_id}</DATASTORE_ID>
+      <DISK_ID>0</DISK_ID>
+      <IMAGE>gold-image</IMAGE>
+      <IMAGE_ID>42</IMAGE_ID>
+      <SIZE>10240</SIZE>
+    </DISK>
+    <GRAPHICS><LISTEN>0.0.0.0</LISTEN><TYPE>VNC</TYPE></GRAPHICS>
+    <MEMORY>2048</MEMORY>
+    <NIC><IP>10.{b}.{c}.{d}</IP><MAC>02:00:0a:00:00:01</MAC><NETWORK>public</NETWORK></NIC>
+    <TEMPLATE_ID>7</TEMPLATE_ID>
+    <VCPU>1</VCPU>
+    <VMID>{id}</VMID>
+  </TEMPLATE>
+  <USER_TEMPLATE><DESCRIPTION>synthetic</DESCRIPTION></USER_TEMPLATE>
+  <HISTORY_RECORDS>
+    <HISTORY><OID>{id}</OID><SEQ>0</SEQ><HOSTNAME>host-{cluster_id}</HOSTNAME></HISTORY>
+  </HISTORY_RECORDS>
+</VM>"""
+
+
+def synthetic_vm_xml(id, num_clusters=4, done=None):
+  """
+  Builds a <VM> element shaped like those returned by one.vm.info, every
+  tenth VM is DONE unless done is given
+  :param id:
+  :param num_clusters:
+  :param done:
+  :return:
+  """
+  if done is None:
+    done = id % 10 == 0
+  return VM_XML.format(
+    id=id,
+    state=6 if done else 3,
+    lcm_state=0 if done else 3,
+    cluster_id=id % num_clusters,
+    b=(id >> 16) & 255,
+    c=(id >> 8) & 255,
+    d=id & 255)
+
+
+def synthetic_vmpool_xml(num_vms, num_clusters=4):
+  """
+  Builds a VM_POOL document shaped like the one returned by one.vmpool.info
+  :param num_vms:
+  :param num_clusters:
+  :return:
+  """
+  return "<VM_POOL>{}</VM_POOL>".format("".join(synthetic_vm_xml(i, num_clusters) for i in range(num_vms)))
+
+
+class _RequestHandler(SimpleXMLRPCRequestHandler):
+  # the headers and body are written separately, without this every call
+  # on a kept alive connection stalls on a delayed ACK
+  disable_nagle_algorithm = True
+  # keep connections alive like oned does
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    if self.server.latency_s:
+      time.sleep(self.server.latency_s)
+    super().do_POST()
+
+
+class _ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+  daemon_threads = True
+  # asyncio clients open many connections at once
+  request_queue_size = 256
+
+
+class StubOneServer:
+  def __init__(self, num_vms=1000, num_clusters=4, latency_s=0.0, host='127.0.0.1', port=0, multicall=True):
+    """
+    :param num_vms: number of synthetic VMs in the zone (IDs 0..num_vms-1)
+    :param num_clusters:
+    :param latency_s: seconds each request is delayed by
+    :param host:
+    :param port: 0 picks a free port
+    :param multicall: serve system.multicall, False to stand in for an
+    endpoint that doesn't support it
+    """
+    self.num_clusters = num_clusters
+    self.latency_s = latency_s
+    self.vms = {i: synthetic_vm_xml(i, num_clusters) for i in range(num_vms)}
+    self.next_id = num_vms
+    self.calls = {}
+    self._lock = threading.Lock()
+    self.server = _ThreadingXMLRPCServer((host, port), requestHandler=_RequestHandler, logRequests=False, allow_none=True)
+    self.server.latency_s = latency_s
+    if multicall:
+      self.server.register_multicall_functions()
+    for name, f in [('one.vmpool.info', self.vmpool_info),
+                    ('one.vm.info', self.vm_info),
+                    ('one.vm.allocate', self.vm_allocate),
+                    ('one.vm.action', self.vm_action),
+                    ('one.clusterpool.info', self.clusterpool_info)]:
+      self.server.register_function(self._instrumented(name, f), name)
+    self.url = 'http://{}:{}/RPC2'.format(*self.server.server_address)
+
+  def _instrumented(self, name, f):
+    def wrapped(*args):
+      with self._lock:
+        self.calls[name] = self.calls.get(name, 0) + 1
+      return f(*args)
+    return wrapped
+
+  def vmpool_info(self, session, filter, start_id, end_id, state):
+    with self._lock:
+      ids = sorted(self.vms)
+    if start_id != UNLIMITED:
+      ids = [i for i in ids if i >= start_id and (end_id == UNLIMITED or i <= end_id)]
+    vms = [self.vms[i] for i in ids if i in self.vms]
+    if state == EXCEPT_DONE:
+      vms = [vm for vm in vms if '<STATE>6</STATE>' not in vm]
+    return [True, "<VM_POOL>{}</VM_POOL>".format("".join(vms)), 0]
+
+  def vm_info(self, session, id):
+    xml = self.vms.get(id)
+    if xml is None:
+      return [False, "[VirtualMachineInfo] Error getting virtual machine [{}].".format(id), NO_EXISTS]
+    return [True, xml, 0]
+
+  def vm_allocate(self, session, template, hold):
+    with self._lock:
+      id = self.next_id
+      self.next_id += 1
+      self.vms[id] = synthetic_vm_xml(id, self.num_clusters)
+    return [True, id, 0]
+
+  def vm_action(self, session, action, id):
+    with self._lock:
+      if id not in self.vms:
+        return [False, "[VirtualMachineAction] Error getting virtual machine [{}].".format(id), NO_EXISTS]
+      self.vms[id] = synthetic_vm_xml(id, self.num_clusters, done=True)
+    return [True, id, 0]
+
+  def clusterpool_info(self, session):
+    return [True, "<CLUSTER_POOL>{}</CLUSTER_POOL>".format("".join(
+      "<CLUSTER><ID>{0}</ID><NAME>cluster-{0}</NAME></CLUSTER>".format(i) for i in range(self.num_clusters))), 0]
+
+  def start(self):
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
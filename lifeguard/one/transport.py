@@ -0,0 +1,230 @@
+"""
+Pooled HTTP/1.1 keep-alive connections to ONE's XML-RPC endpoints.
+
+xmlrpc.client.ServerProxy keeps its connection open between calls but is not
+thread safe, so instead of each OneProxy (and each worker thread) opening its
+own, a ConnectionPool per endpoint lends out idle ServerProxy objects for the
+duration of a single call.  New TLS connections resume the last TLS session
+negotiated with the endpoint to skip the full handshake.
+"""
+import http.client
+import ssl
+import threading
+import xmlrpc.client
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+DEFAULT_MAX_IDLE = 16
+
+
+class _SessionReusingHTTPSConnection(http.client.HTTPSConnection):
+  def __init__(self, host, pool, **kwargs):
+    self.pool = pool
+    super().__init__(host, context=pool.ssl_context, **kwargs)
+
+  def connect(self):
+    http.client.HTTPConnection.connect(self)
+    server_hostname = self._tunnel_host if self._tunnel_host else self.host
+    self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.pool.tls_session)
+    self.pool._handshake(self.sock)
+
+  def close(self):
+    if self.sock is not None:
+      # TLS 1.3 tickets only arrive after the handshake so keep the latest
+      self.pool._remember_session(self.sock)
+    super().close()
+
+
+class _PooledTransport(xmlrpc.client.Transport):
+  """
+  Keeps a single connection open like the stock Transport, counting new
+  connections and reuses against the pool it belongs to
+  """
+  def __init__(self, pool):
+    super().__init__()
+    self.pool = pool
+
+  def make_connection(self, host):
+    if self._connection[1] is not None and host == self._connection[0]:
+      self.pool._count('reuses')
+      return self._connection[1]
+    chost, self._extra_headers, x509 = self.get_host_info(host)
+    if self.pool.https:
+      connection = _SessionReusingHTTPSConnection(chost, self.pool, **(x509 or {}))
+    else:
+      connection = http.client.HTTPConnection(chost)
+    self._connection = host, connection
+    self.pool._count('connections_opened')
+    return connection
+
+  def close(self):
+    if self._connection[1] is not None:
+      self.pool._count('connections_closed')
+    super().close()
+
+
+class ConnectionPool:
+  """
+  A thread safe pool of ServerProxy objects for one XML-RPC endpoint, each
+  holding a keep-alive connection.  Proxies are checked out for a single
+  call and returned most recently used first so the warmest connections are
+  reused and surplus ones are left to be closed.
+  """
+
+  def __init__(self, uri, ssl_context=None, max_idle=DEFAULT_MAX_IDLE):
+    """
+    :param uri: the xmlrpc_uri of the zone
+    :param ssl_context: used for every TLS connection in the pool
+    :param max_idle: idle proxies beyond this many are closed when returned
+    """
+    self.uri = uri
+    self.https = urlparse(uri).scheme == 'https'
+    self.ssl_context = ssl_context
+    self.max_idle = max_idle
+    self.tls_session = None
+    # cleared by lifeguard.one.batch the first time system.multicall faults
+    self.multicall_supported = True
+    self._lock = threading.Lock()
+    self._idle = []
+    self._counters = {'connections_opened': 0,
+                      'connections_closed': 0,
+                      'reuses': 0,
+                      'tls_sessions_resumed': 0,
+                      'checkouts': 0,
+                      'multicalls': 0,
+                      'batched_calls': 0}
+
+  def _count(self, counter, n=1):
+    with self._lock:
+      self._counters[counter] += n
+
+  def _remember_session(self, sock):
+    session = getattr(sock, 'session', None)
+    if session is not None:
+      self.tls_session = session
+
+  def _handshake(self, sock):
+    if sock.session_reused:
+      self._count('tls_sessions_resumed')
+    self._remember_session(sock)
+
+  @contextmanager
+  def checkout(self):
+    """
+    Lends out a ServerProxy for the duration of the with block, it must not
+    be used by any other thread until it is returned
+    :return:
+    """
+    with self._lock:
+      self._counters['checkouts'] += 1
+      proxy = self._idle.pop() if self._idle else None
+    if proxy is None:
+      proxy = xmlrpc.client.ServerProxy(self.uri, transport=_PooledTransport(self))
+    try:
+      yield proxy
+    except Exception:
+      # the connection may have been left mid response
+      proxy('close')()
+      raise
+    with self._lock:
+      if len(self._idle) < self.max_idle:
+        self._idle.append(proxy)
+        proxy = None
+    if proxy is not None:
+      proxy('close')()
+
+  def close(self):
+    """
+    Closes every idle connection in the pool
+    :return:
+    """
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for proxy in idle:
+      proxy('close')()
+
+  def stats(self):
+    """
+    :return: dict of open_connections, idle_connections, reuses,
+    handshakes_avoided, tls_sessions_resumed and the raw counters
+    """
+    with self._lock:
+      stats = dict(self._counters)
+      stats['idle_connections'] = len(self._idle)
+    stats['open_connections'] = stats['connections_opened'] - stats['connections_closed']
+    # reuses skip TCP and TLS entirely, resumed sessions skip the full TLS handshake
+    stats['handshakes_avoided'] = stats['reuses'] + stats['tls_sessions_resumed']
+    return stats
+
+
+class _PooledMethod:
+  def __init__(self, pool, name):
+    self.pool = pool
+    self.name = name
+
+  def __getattr__(self, name):
+    return _PooledMethod(self.pool, "{}.{}".format(self.name, name))
+
+  def __call__(self, *args):
+    with self.pool.checkout() as proxy:
+      return getattr(proxy, self.name)(*args)
+
+
+class PooledServerProxy:
+  """
+  Thread safe stand in for a ServerProxy, every call is made on a proxy
+  checked out of the pool, e.g. PooledServerProxy(pool).one.vm.info(...)
+  """
+  def __init__(self, pool):
+    self.pool = pool
+
+  def __getattr__(self, name):
+    return _PooledMethod(self.pool, name)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(uri, verify_certs=True):
+  """
+  Returns the process wide connection pool for uri, creating it on first use
+  :param uri: the xmlrpc_uri of the zone
+  :param verify_certs:
+  :return: ConnectionPool
+  """
+  with _pools_lock:
+    pool = _pools.get((uri, verify_certs))
+    if pool is None:
+      pool = ConnectionPool(uri, ssl_context=new_ssl_context(verify_certs))
+      _pools[(uri, verify_certs)] = pool
+    return pool
+
+
+def new_ssl_context(verify_certs=True):
+  ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+  if verify_certs:
+    ssl_context.verify_mode = ssl.CERT_OPTIONAL
+  else:
+    ssl_context.verify_mode = ssl.CERT_NONE
+  return ssl_context
+
+
+def pool_stats(uri=None):
+  """
+  :param uri: stats for the pools of a single xmlrpc_uri, or all pools if None
+  :return: dict of uri to stats, summed over the pools sharing a uri
+  """
+  with _pools_lock:
+    pools = list(_pools.values())
+  stats = {}
+  for pool in pools:
+    if uri is not None and pool.uri != uri:
+      continue
+    pool_stats = pool.stats()
+    if pool.uri in stats:
+      for k, v in pool_stats.items():
+        stats[pool.uri][k] += v
+    else:
+      stats[pool.uri] = pool_stats
+  return stats
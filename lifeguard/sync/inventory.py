@@ -0,0 +1,175 @@
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+# attributes of a VM that change when it's reinstantiated from a different template
+TEMPLATE_ATTRS = ('name',
+                  'template_id',
+                  'memory',
+                  'cpu',
+                  'vcpu',
+                  'disk_datastore_id',
+                  'image_id',
+                  'image_name',
+                  'ip_address')
+
+
+class InventoryDelta:
+  """
+  What changed in a zone's VMs between two syncs.  added and the *_changed
+  lists hold the VMs as they are now, removed holds them as they were.
+  The first sync of a zone (initial=True) reports every VM as added.
+  """
+  def __init__(self, key, initial=False):
+    self.key = key
+    self.initial = initial
+    self.added = []
+    self.removed = []
+    self.state_changed = []
+    self.template_changed = []
+    self.synced_at = time.time()
+
+  def changed_ids(self):
+    """
+    :return: set of the IDs of every VM in the delta
+    """
+    return {vm.id for vms in (self.added, self.removed, self.state_changed, self.template_changed) for vm in vms}
+
+  def is_empty(self):
+    return not (self.added or self.removed or self.state_changed or self.template_changed)
+
+  def __str__(self):
+    return 'InventoryDelta: key={}, initial={}, added={}, removed={}, state_changed={}, template_changed={}'.format(
+      self.key,
+      self.initial,
+      len(self.added),
+      len(self.removed),
+      len(self.state_changed),
+      len(self.template_changed))
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class InventorySync:
+  """
+  Keeps the last snapshot of each zone's VMs and turns every newly fetched
+  inventory into a delta against it, so callers only do work for the VMs
+  that changed.
+
+  Snapshots are kept in memory and, once persist() has been called, pickled
+  so a short lived process (e.g. a bin script) sees the delta since its own
+  last run.  Each such consumer has its own snapshots as the delta one gets
+  must not depend on when another last synced.
+  """
+
+  def __init__(self, snapshot_dir=None, consumer=None, name='inventory sync'):
+    """
+    :param snapshot_dir: directory the snapshots are persisted to, None to
+    only keep them in memory
+    :param consumer: names the process's snapshots in snapshot_dir
+    :param name: used when logging
+    """
+    self.snapshot_dir = snapshot_dir
+    self.consumer = consumer
+    self.name = name
+    self._lock = threading.Lock()
+    self._key_locks = {}
+    self._snapshots = {}
+
+  def persist(self, snapshot_dir, consumer):
+    """
+    Persists this process's snapshots from now on, the web app only keeps
+    them in memory
+    :param snapshot_dir:
+    :param consumer: names the process's snapshots in snapshot_dir, e.g.
+    health_tasks
+    :return:
+    """
+    self.snapshot_dir = snapshot_dir
+    self.consumer = consumer
+
+  def _snapshot_path(self, key):
+    return os.path.join(self.snapshot_dir, 'vm-inventory-{}-{}.pickle'.format(self.consumer, key))
+
+  def _load_snapshot(self, key):
+    if self.snapshot_dir is None:
+      return None
+    try:
+      with open(self._snapshot_path(key), 'rb') as f:
+        return pickle.load(f)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      logging.warning("{} ignoring unreadable snapshot for {}: {}".format(self.name, key, e))
+      return None
+
+  def _save_snapshot(self, key, snapshot):
+    if self.snapshot_dir is None:
+      return
+    path = self._snapshot_path(key)
+    fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, prefix=os.path.basename(path), suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path, path)
+    except BaseException:
+      os.unlink(tmp_path)
+      raise
+
+  def snapshot(self, key):
+    """
+    :param key:
+    :return: dict of VM ID to VirtualMachine from the last sync, or None.
+    It is shared and must not be modified.
+    """
+    return self._snapshots.get(key)
+
+  @staticmethod
+  def diff(key, old, new):
+    """
+    :param key:
+    :param old: dict of VM ID to VirtualMachine, None if there wasn't one
+    :param new: dict of VM ID to VirtualMachine
+    :return: InventoryDelta
+    """
+    if old is None:
+      delta = InventoryDelta(key, initial=True)
+      delta.added = list(new.values())
+      return delta
+    delta = InventoryDelta(key)
+    for id, vm in new.items():
+      previous = old.get(id)
+      if previous is None:
+        delta.added.append(vm)
+        continue
+      if previous.state_id != vm.state_id or previous.lcm_state_id != vm.lcm_state_id:
+        delta.state_changed.append(vm)
+      if any(getattr(previous, attr) != getattr(vm, attr) for attr in TEMPLATE_ATTRS):
+        delta.template_changed.append(vm)
+    delta.removed = [vm for id, vm in old.items() if id not in new]
+    return delta
+
+  def sync(self, key, vms):
+    """
+    Replaces the snapshot of key with vms
+    :param key: identifies the zone
+    :param vms: iterable of the zone's VirtualMachine objects
+    :return: InventoryDelta
+    """
+    with self._lock:
+      key_lock = self._key_locks.setdefault(key, threading.Lock())
+    # syncs of the same zone must be applied in order
+    with key_lock:
+      new = {vm.id: vm for vm in vms}
+      old = self._snapshots.get(key)
+      if old is None:
+        old = self._load_snapshot(key)
+      delta = InventorySync.diff(key, old, new)
+      self._snapshots[key] = new
+      self._save_snapshot(key, new)
+    logging.info("{} {}".format(self.name, delta))
+    return delta
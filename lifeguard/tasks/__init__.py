@@ -1,21 +1,55 @@
-from lifeguard.database import Session
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from lifeguard.views.vpool.models import VirtualMachinePool
-from lifeguard.one import OneProxy, INCLUDING_DONE
 import logging
+import traceback
 
-def all_pools_and_members():
+def _fetch_zone_inventory(zone):
   """
-  Gets all pools efficiently by caching VMs per zone
-  :return: A array of pool, member_array tuples
+  Syncs the zone's VM inventory, run on a worker thread per zone.  Only
+  touches the zone's already loaded columns so no SQL is issued off the
+  main thread.
+  :param zone:
+  :return: InventoryDelta, VMs keyed by ID
   """
-  a = []
-  zone_vm_cache = {}
-  for pool in Session.query(VirtualMachinePool).all():
-    if not pool.cluster.zone.name in zone_vm_cache:
-      logging.info("VM cache for zone {} doesn't exist...".format(pool.cluster.zone.name))
-      one_proxy = OneProxy(pool.cluster.zone.xmlrpc_uri, pool.cluster.zone.session_string, verify_certs=False)
-      zone_vm_cache[pool.cluster.zone.name] = {vm.id: vm for vm in one_proxy.get_vms(INCLUDING_DONE)}
-      logging.info("VM cache for zone {} populated with {} entries".format(
-        pool.cluster.zone.name, len(zone_vm_cache[pool.cluster.zone.name])))
-    a.append((pool, pool.get_memberships(vm_cache=zone_vm_cache[pool.cluster.zone.name])))
-  return a
+  return zone.sync_vm_inventory()
+
+def all_pools_and_members(changed_only=False):
+  """
+  Gets all pools efficiently by syncing the VM inventory once per zone,
+  every zone concurrently.  The pools of each zone are yielded as soon as
+  its inventory lands so consumers can start before the slowest zone is done.
+  A zone whose inventory can't be fetched is logged and its pools skipped.
+  :param changed_only: only return the pools with a member whose VM was
+  added, removed or changed state or template since the zone's last sync
+  :return: A generator of pool, member_array tuples
+  """
+  # the pools, their clusters and zones and every membership are loaded
+  # in two queries rather than lazily per pool
+  pools, pool_memberships = VirtualMachinePool.load_all_with_memberships()
+  zone_pools = {}
+  zones = {}
+  for pool in pools:
+    zone = pool.cluster.zone
+    zones[zone.number] = zone
+    zone_pools.setdefault(zone.number, []).append(pool)
+  if not zones:
+    return
+  with ThreadPoolExecutor(max_workers=len(zones)) as executor:
+    futures = {executor.submit(_fetch_zone_inventory, zone): zone for zone in zones.values()}
+    for future in as_completed(futures):
+      zone = futures[future]
+      try:
+        delta, vm_cache = future.result()
+      except Exception as e:
+        logging.error("failed to fetch VM inventory for zone {}, skipping its pools: {}\n{}".format(
+          zone.name, e, ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+        continue
+      logging.info("VM cache for zone {} populated with {} entries, {}".format(
+        zone.name, len(vm_cache), delta))
+      changed_ids = None if delta.initial else delta.changed_ids()
+      for pool in zone_pools[zone.number]:
+        memberships = pool_memberships[pool.id]
+        if changed_only and changed_ids is not None:
+          if not changed_ids.intersection(m.vm_id for m in memberships):
+            continue
+        yield pool, pool.get_memberships(vm_cache=vm_cache, memberships=memberships)
@@ -1,13 +1,11 @@
 from flask import request, render_template, flash, redirect, url_for, Blueprint
 from flask_login import login_required
-from jinja2 import Environment
 from lifeguard.views.cluster.models import Cluster, ClusterTemplateForm, CreateVmForm, GenerateTemplateForm
 from lifeguard.views.zone.models import Zone
 from lifeguard.views.vpool.models import VirtualMachinePool
-from lifeguard import app, jira
-from lifeguard.one import OneProxy
+from lifeguard import app, jira, templates
 
-from lifeguard.views.template.models import ObjectLoader, VarParser
+from lifeguard.views.template.models import VarParser
 from lifeguard.database import Session
 
 cluster_bp = Blueprint('cluster_bp', __name__, template_folder='templates')
@@ -71,9 +69,8 @@ def vm_create(zone_number, cluster_id):
         zone.vars,
         cluster.vars,
         vm_vars)
-      one_proxy = OneProxy(zone.xmlrpc_uri, zone.session_string, verify_certs=False)
-      env = Environment(loader=ObjectLoader())
-      vm_template = env.from_string(cluster.template).render(cluster=cluster, vars=vars)
+      one_proxy = zone.get_one_proxy()
+      vm_template = templates.get(cluster.template, zone.template).render(cluster=cluster, vars=vars)
       issue = jira.instance.create_issue(
         project=app.config['JIRA_PROJECT'],
         summary='[auto] VM instantiated: {}'.format(vars['hostname']),
@@ -111,8 +108,7 @@ def gen_template(zone_number, cluster_id):
         zone.vars,
         cluster.vars,
         var_string)
-      env = Environment(loader=ObjectLoader())
-      template = env.from_string(cluster.template).render(cluster=cluster, vars=vars)
+      template = templates.get(cluster.template, zone.template).render(cluster=cluster, vars=vars)
       flash('Template Generated for {}'.format(cluster.name))
     except Exception as e:
       raise e
@@ -0,0 +1,75 @@
+"""
+Benchmarks of building the vars every member's template is rendered with:
+
+  python -m lifeguard.views.template.benchmark
+"""
+import time
+from lifeguard.views.template.models import VarParser
+
+
+def _parse_kv_strings_uncached(*args):
+  """
+  The parsing parse_kv_strings_to_dict did before it was memoized, every
+  string split and stripped on every call
+  """
+  parsed = {}
+  for arg in args:
+    if not arg:
+      continue
+    for kv in arg.split("\n"):
+      k, v = kv.split("=", 2)
+      parsed[k.strip()] = v.strip()
+  return parsed
+
+
+def synthetic_vars(prefix, num_lines):
+  return "\n".join("{}_var_{} = value {} of {}".format(prefix, i, i, prefix) for i in range(num_lines))
+
+
+def bench_host_vars(num_members=1000, num_lines=200, lookups=('zone_var_1', 'cluster_var_2', 'pool_var_3', 'hostname')):
+  """
+  Builds the vars of every member of a pool (as current_template does for
+  each member on every drift check) from zone, cluster and pool vars of
+  num_lines lines each, then looks a few of them up as a template would
+  :param num_members:
+  :param num_lines: lines in each of the zone, cluster and pool vars
+  :param lookups: vars looked up per member
+  :return: seconds taken per member re-parsing every time and with host_vars
+  """
+  zone_vars = synthetic_vars('zone', num_lines)
+  cluster_vars = synthetic_vars('cluster', num_lines)
+  pool_vars = synthetic_vars('pool', num_lines)
+  hostnames = ['host{}.example.com'.format(i) for i in range(num_members)]
+
+  def uncached():
+    for hostname in hostnames:
+      vars = _parse_kv_strings_uncached(zone_vars, cluster_vars, pool_vars, 'hostname={}'.format(hostname))
+      for k in lookups:
+        vars[k]
+
+  def memoized():
+    for hostname in hostnames:
+      vars = VarParser.host_vars(zone_vars, cluster_vars, pool_vars, hostname)
+      for k in lookups:
+        vars[k]
+
+  expected = _parse_kv_strings_uncached(zone_vars, cluster_vars, pool_vars, 'hostname=host0.example.com')
+  if dict(VarParser.host_vars(zone_vars, cluster_vars, pool_vars, 'host0.example.com')) != expected:
+    raise Exception("host_vars differs from parsing the vars")
+  results = []
+  for name, f in [('re-parsed', uncached), ('host_vars', memoized)]:
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    results.append(elapsed / num_members)
+    print("{:>10}: {:.3f}s for {} members, {:.1f}us per member".format(
+      name, elapsed, num_members, elapsed / num_members * 1e6))
+  return tuple(results)
+
+
+def run():
+  bench_host_vars()
+
+
+if __name__ == '__main__':
+  run()
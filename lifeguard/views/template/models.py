@@ -1,9 +1,98 @@
-from jinja2 import BaseLoader
+import hashlib
+import threading
+from collections import ChainMap, OrderedDict
+from functools import lru_cache
+from types import MappingProxyType
+from jinja2 import BaseLoader, Environment
+
+# number of distinct vars strings (and zone, cluster, pool combinations of
+# them) kept parsed
+VARS_CACHE_SIZE = 1024
 
 class ObjectLoader(BaseLoader):
 
   def get_source(self, environment, obj):
-    return obj, None, None
+    # the template's "name" is its source, a compiled template found under
+    # it in the environment's cache can't be out of date
+    return obj, None, lambda: True
+
+class TemplateCache():
+  """
+  Compiled templates shared by every render in the process.  Templates are
+  compiled on one Environment whose own cache holds the templates they
+  extend, and kept in an LRU keyed by a hash of their text along with that
+  of the zone and cluster templates they extend.
+  """
+
+  def __init__(self, max_size=256, name='template cache'):
+    """
+    :param max_size: number of compiled templates to keep
+    :param name: used when logging
+    """
+    self.max_size = max_size
+    self.name = name
+    self.env = Environment(loader=ObjectLoader(), cache_size=max_size)
+    self._lock = threading.Lock()
+    self._compiled = OrderedDict()
+    self._counters = {'hits': 0, 'compiles': 0}
+
+  @staticmethod
+  def key(*sources):
+    """
+    :param sources: template texts, None is treated as blank
+    :return: hash identifying the combination of sources
+    """
+    digest = hashlib.sha256()
+    for source in sources:
+      digest.update((source or '').encode('utf-8'))
+      digest.update(b'\0')
+    return digest.hexdigest()
+
+  def get(self, source, *extended):
+    """
+    Returns source compiled, compiling it only if it isn't cached
+    :param source: the template text
+    :param extended: the text of the templates it extends (e.g. the zone and
+    cluster templates), part of the cache key
+    :return: jinja2.Template
+    """
+    key = TemplateCache.key(source, *extended)
+    with self._lock:
+      template = self._compiled.get(key)
+      if template is not None:
+        self._compiled.move_to_end(key)
+        self._counters['hits'] += 1
+        return template
+    # compiled outside the lock, two threads racing on the same new template
+    # both compile it and the last one wins
+    template = self.env.from_string(source)
+    with self._lock:
+      self._counters['compiles'] += 1
+      self._compiled[key] = template
+      while len(self._compiled) > self.max_size:
+        self._compiled.popitem(last=False)
+    return template
+
+  def stats(self):
+    """
+    :return: dict of hits, compiles and size
+    """
+    with self._lock:
+      stats = dict(self._counters)
+      stats['size'] = len(self._compiled)
+    return stats
+
+@lru_cache(maxsize=VARS_CACHE_SIZE)
+def _parse_kv_string(kv_string):
+  """
+  :param kv_string: key=val lines
+  :return: read only dict of the parsed vars, memoized by content
+  """
+  parsed = {}
+  for kv in kv_string.split("\n"):
+    k, v = kv.split("=", 2)
+    parsed[k.strip()] = v.strip()
+  return MappingProxyType(parsed)
 
 class VarParser():
 
@@ -18,6 +107,7 @@ class VarParser():
 
     String args can be none or blank and they will be skipped
     otherwise they are expected to be in key=val (one per line).
+    Each distinct string is only parsed once.
 
     Dict objects can be empty and they will be skipped,
     otherwise they are expected to be 1 level deep (cannot be
@@ -46,14 +136,40 @@ class VarParser():
       elif type(args[i]) is str:
         if args[i]  == "":
           continue
-        for kv in args[i].split("\n"):
-          k, v = kv.split("=", 2)
-          parsed[k.strip()] = v.strip()
+        parsed.update(_parse_kv_string(args[i]))
       else:
         raise Exception('arg {} is {} (not a string or dict)'
                         .format(i, type(args[i])))
     return parsed
 
+  @staticmethod
+  @lru_cache(maxsize=VARS_CACHE_SIZE)
+  def merged(*args):
+    """
+    Like parse_kv_strings_to_dict but only takes strings (or None) and is
+    memoized, the result is shared so it's read only
+    :param args:
+    :return: read only dict
+    """
+    return MappingProxyType(VarParser.parse_kv_strings_to_dict(*args))
 
+  @staticmethod
+  def host_vars(zone_vars, cluster_vars, pool_vars, hostname):
+    """
+    The vars a host's template is rendered with, the same as
 
+    parse_kv_strings_to_dict(
+      zone_vars,
+      cluster_vars,
+      pool_vars,
+      'hostname={}'.format(hostname))
 
+    but the zone, cluster and pool vars are merged once and shared by
+    every host, only the hostname is layered on top per host
+    :param zone_vars:
+    :param cluster_vars:
+    :param pool_vars:
+    :param hostname:
+    :return: ChainMap
+    """
+    return ChainMap({'hostname': hostname.strip()}, VarParser.merged(zone_vars, cluster_vars, pool_vars))
@@ -1,16 +1,14 @@
 import re
 from flask import request, redirect, url_for, render_template, flash, Blueprint, g, Markup
 from flask_login import login_required
-from jinja2 import Environment
 from datetime import datetime
 from flask_login import current_user
 from lifeguard import app, jira
 from lifeguard.database import Session
-from lifeguard.one import OneProxy
 from lifeguard.views.task.models import Task, TaskThread
-from lifeguard.views.template.models import ObjectLoader, VarParser
+from lifeguard.views.template.models import VarParser
 from lifeguard.views.vpool.models import PoolMembership, VirtualMachinePool, PoolEditForm, GenerateTemplateForm, \
-  ExpandException
+  ExpandException, VmInventory, VmInventoryRefresh
 from lifeguard.views.vpool.elasticity_planning import plan_expansion, plan_update, plan_shrink
 from lifeguard.views.vpool.health import Diagnostic
 from lifeguard.views.common.models import ActionForm
@@ -56,13 +54,26 @@ def remove_done(pool_id):
             "\n*".join(['ID {}: {} ({})'.format(m.vm.id, m.vm.name, m.vm.ip_address) for m in delete_members])),
           customfield_13842=jira.get_datetime_now(),
           issuetype={'name': 'Task'})
-        one_proxy = OneProxy(pool.cluster.zone.xmlrpc_uri, pool.cluster.zone.session_string, verify_certs=False)
+        one_proxy = pool.cluster.zone.get_one_proxy()
+        vm_ids_by_cmd = {}
         for m in delete_members:
-          one_proxy.action_vm(m.remove_cmd(), m.vm.id)
-          Session.delete(m)
+          if not m.vm.vanished:
+            vm_ids_by_cmd.setdefault(m.remove_cmd(), []).append(m.vm.id)
+        errors = {}
+        for cmd, vm_ids in vm_ids_by_cmd.items():
+          result = one_proxy.action_vms(cmd, vm_ids)
+          logging.info("cleanup of pool {}: {}".format(pool.name, result))
+          errors.update(result.errors)
+        for m in delete_members:
+          if m.vm.id not in errors:
+            Session.delete(m)
         Session.commit()
-        flash('Deleted {} done VMs to cleanup pool {}'.format(len(delete_members), pool.name))
-        jira.resolve(delete_ticket)
+        flash('Deleted {} done VMs to cleanup pool {}'.format(len(delete_members) - len(errors), pool.name))
+        if errors:
+          flash('Failed to delete {} VMs: {}'.format(len(errors), "; ".join(
+            'ID {}: {}'.format(id, error) for id, error in sorted(errors.items()))), category='danger')
+        else:
+          jira.resolve(delete_ticket)
         return redirect(url_for('vpool_bp.view', pool_id=pool.id))
     except Exception as e:
       flash("Error performing cleanup of pool {}: {}".format(pool.name, e), category='danger')
@@ -206,7 +217,8 @@ def view(pool_id):
   return render_template('vpool/view.html',
                          form=form,
                          pool=pool,
-                         members=members)
+                         members=members,
+                         outdated=pool.outdated_members(members))
 
 @vpool_bp.route('/vpool/health/<int:pool_id>', methods=['GET', 'POST'])
 @login_required
@@ -306,7 +318,7 @@ def edit(pool_id):
         Session.add(pool)
         for m in members:
           if m.template == 'not-yet-compiled':
-            m.template = ''
+            m.set_template('')
           Session.add(m)
         Session.commit()
         flash('Successfully saved pool template for {} (ID={}).'
@@ -384,8 +396,7 @@ def gen_template(pool_id):
         cluster.vars,
         pool.vars,
         var_string)
-      env = Environment(loader=ObjectLoader())
-      template = env.from_string(pool.template).render(pool=pool, cluster=cluster, vars=vars)
+      template = pool.compiled_template().render(pool=pool, cluster=cluster, vars=vars)
       flash('Template Generated for {}'.format(pool.name))
     except Exception as e:
       flash("Error generating template: {}".format(e), category='danger')
@@ -408,17 +419,21 @@ def assign_to_pool(zone_number, cluster_id):
   zone = None
   cluster = None
   memberships = {}
+  inventory_as_of = None
   try:
     Session()
     zone = Zone.query.get(zone_number)
     cluster = Cluster.query.filter_by(zone=zone, id=cluster_id).first()
-    one_proxy = OneProxy(zone.xmlrpc_uri, zone.session_string, verify_certs=False)
     for membership in PoolMembership.query.join(VirtualMachinePool).filter_by(cluster=cluster).all():
       memberships[membership.vm_id] = membership
-    for vm in one_proxy.get_vms():
-      if vm.disk_cluster.id == cluster.id:
-        vms.append(vm)
-        id_to_vm[vm.id] = vm
+    inventory_as_of = VmInventoryRefresh.as_of(zone.number)
+    if inventory_as_of is not None:
+      cluster_vms = VmInventory.get_cluster_vms(zone.number, cluster.id)
+    else:
+      cluster_vms = [vm for vm in zone.get_one_proxy().get_vms() if vm.disk_cluster.id == cluster.id]
+    for vm in cluster_vms:
+      vms.append(vm)
+      id_to_vm[vm.id] = vm
     pools = VirtualMachinePool.get_all(cluster)
   except Exception as e:
     # raise e
@@ -493,5 +508,6 @@ def assign_to_pool(zone_number, cluster_id):
     memberships=memberships,
     selected_vm_ids=selected_vm_ids,
     pools=pools,
-    active_tab_name=active_tab
+    active_tab_name=active_tab,
+    inventory_as_of=inventory_as_of
   )
\ No newline at end of file
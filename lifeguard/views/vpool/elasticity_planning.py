@@ -1,13 +1,101 @@
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor
 from lifeguard.database import Session
 from lifeguard import app, jira
-from jinja2 import Environment
-from lifeguard.views.template.models import VarParser, ObjectLoader
 from lifeguard.views.vpool.models import PoolTicket, PoolTicketActions
+from lifeguard.views.vpool.template_archive import archive_filename, pack_templates
 from math import ceil, floor
 
+class PhaseTimer:
+  """
+  Adds up the time spent in each phase of planning (render, upload, transition)
+  """
+  def __init__(self):
+    self.elapsed = {}
+
+  def time(self, phase, f, *args, **kwargs):
+    """
+    Calls f(*args, **kwargs) counting the time it takes towards phase
+    :return: whatever f returns
+    """
+    start = time.monotonic()
+    try:
+      return f(*args, **kwargs)
+    finally:
+      self.elapsed[phase] = self.elapsed.get(phase, 0) + time.monotonic() - start
+
+  def __str__(self):
+    return ", ".join("{} {:.1f}s".format(phase, elapsed) for phase, elapsed in self.elapsed.items())
+
+def render_templates(pool, hostnames, timer):
+  """
+  Renders the template of each host on TEMPLATE_RENDER_WORKERS threads
+  :param pool: its cluster and zone are loaded up front so the workers
+  don't lazy load anything
+  :param hostnames:
+  :param timer: PhaseTimer
+  :return: list of the templates in the order of hostnames
+  """
+  pool.compiled_template()
+  with ThreadPoolExecutor(max_workers=app.config['TEMPLATE_RENDER_WORKERS']) as executor:
+    return timer.time('render', lambda: list(executor.map(pool.render_template, hostnames)))
+
+def upload_archive(log, task, pool, attachments, timer):
+  """
+  Attaches the templates to the task as a single archive
+  :param log: DumbLog
+  :param task: Jira issue
+  :param pool:
+  :param attachments: list of filename, template, message to log on success
+  :param timer: PhaseTimer
+  :return:
+  """
+  filename = archive_filename(pool.id)
+  archive = pack_templates([(f, template) for f, template, message in attachments])
+  timer.time('upload', jira.instance.add_attachment, issue=task, filename=filename, attachment=io.BytesIO(archive))
+  for f, template, message in attachments:
+    log.msg(message)
+  log.msg("Attached {} templates to task {} as {} ({} bytes)".format(len(attachments), task.key, filename, len(archive)))
+
+def upload_attachments(log, task, pool, attachments, timer):
+  """
+  Attaches the templates to the task with up to ATTACHMENT_UPLOAD_WORKERS
+  uploads in flight, or as one archive if ATTACHMENT_ARCHIVE is set.  Each
+  attachment is logged in order once they've all finished, the first that
+  failed (if any) is raised.
+  :param log: DumbLog
+  :param task: Jira issue
+  :param pool:
+  :param attachments: list of filename, template, message to log on success
+  :param timer: PhaseTimer
+  :return:
+  """
+  if app.config['ATTACHMENT_ARCHIVE']:
+    return upload_archive(log, task, pool, attachments, timer)
+  def upload(attachment):
+    filename, template, message = attachment
+    try:
+      jira.instance.add_attachment(
+        issue=task,
+        filename=filename,
+        attachment=io.StringIO(template))
+    except Exception as e:
+      return e
+  with ThreadPoolExecutor(max_workers=app.config['ATTACHMENT_UPLOAD_WORKERS']) as executor:
+    errors = timer.time('upload', lambda: list(executor.map(upload, attachments)))
+  for (filename, template, message), error in zip(attachments, errors):
+    if error is None:
+      log.msg(message)
+    else:
+      log.err("Failed to attach {} to task {}: {}".format(filename, task.key, error))
+  for error in errors:
+    if error is not None:
+      raise error
+
 def plan_expansion(self, pool, expansion_names):
   task = crq = None
+  timer = PhaseTimer()
   try:
     pool = Session.merge(pool)
     start, end = jira.next_immediate_window_dates()
@@ -26,7 +114,7 @@ def plan_expansion(self, pool, expansion_names):
       customfield_14135={'value': 'IPG', 'child': {'value': 'IPG Big Data'}},
       customfield_17679="Pool expansion required")
     self.log.msg("Created change request: {}".format(crq.key))
-    jira.instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_PLANNING'])
+    timer.time('transition', jira.instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_PLANNING'])
     self.log.msg("Transitioned {} to planning".format(crq.key))
     jira.instance.create_issue_link('Relate', crq, logging)
     self.log.msg("Related {} to LOGGING service {}".format(crq.key, logging.key))
@@ -41,31 +129,24 @@ def plan_expansion(self, pool, expansion_names):
       customfield_14135={'value': 'IPG', 'child': {'value': 'IPG Big Data'}},
       customfield_15150={'value': 'No'})
     self.log.msg("Created task: {}".format(task.key))
-    jira.instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_PLANNING'])
+    timer.time('transition', jira.instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_PLANNING'])
     self.log.msg("Transitioned {} to planning".format(task.key))
-    env = Environment(loader=ObjectLoader())
-    for hostname in expansion_names:
-      vars = VarParser.parse_kv_strings_to_dict(
-        pool.cluster.zone.vars,
-        pool.cluster.vars,
-        pool.vars,
-        'hostname={}'.format(hostname))
-      vm_template = env.from_string(pool.template).render(pool=pool, vars=vars)
-      attachment_content = io.StringIO(vm_template)
-      jira.instance.add_attachment(
-        issue=task,
-        filename='{}.{}.template'.format(pool.id, hostname),
-        attachment=attachment_content)
-      self.log.msg("Attached template for {} to task {}".format(hostname, task.key))
-    jira.instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_WRITTEN'])
+    vm_templates = render_templates(pool, expansion_names, timer)
+    upload_attachments(self.log, task, pool, [
+      ('{}.{}.template'.format(pool.id, hostname),
+       vm_template,
+       "Attached template for {} to task {}".format(hostname, task.key))
+      for hostname, vm_template in zip(expansion_names, vm_templates)], timer)
+    timer.time('transition', jira.instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_WRITTEN'])
     self.log.msg("Transitioned task {} to written".format(task.key))
-    jira.approver_instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_APPROVED'])
+    timer.time('transition', jira.approver_instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_APPROVED'])
     self.log.msg("Approved task {}".format(task.key))
-    jira.instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_PLANNED_CHANGE'])
+    timer.time('transition', jira.instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_PLANNED_CHANGE'])
     self.log.msg("Transitioned task {} to approved".format(task.key))
-    jira.approver_instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_APPROVED'])
+    timer.time('transition', jira.approver_instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_APPROVED'])
     self.log.msg("Transitioned change request {} to approved".format(crq.key))
     self.log.msg("Task ID {}".format(self.task.id))
+    self.log.msg("Planning took {}".format(timer))
     db_ticket = PoolTicket(
       pool=Session.merge(pool),
       action_id=PoolTicketActions.expand.value,
@@ -81,6 +162,7 @@ def plan_expansion(self, pool, expansion_names):
 
 def plan_update(self, pool, update_members):
   task = crq = None
+  timer = PhaseTimer()
   try:
     pool = Session.merge(pool)
     start, end = jira.next_immediate_window_dates()
@@ -99,7 +181,7 @@ def plan_update(self, pool, update_members):
       customfield_14135={'value': 'IPG', 'child': {'value': 'IPG Big Data'}},
       customfield_17679="Pool update required")
     self.log.msg("Created change request: {}".format(crq.key))
-    jira.instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_PLANNING'])
+    timer.time('transition', jira.instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_PLANNING'])
     self.log.msg("Transitioned {} to planning".format(crq.key))
     jira.instance.create_issue_link('Relate', crq, logging)
     self.log.msg("Related {} to LOGGING service {}".format(crq.key, logging.key))
@@ -123,27 +205,24 @@ def plan_update(self, pool, update_members):
         customfield_14135={'value': 'IPG', 'child': {'value': 'IPG Big Data'}},
         customfield_15150={'value': 'No'})
       self.log.msg("Created task: {}".format(task.key))
-      jira.instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_PLANNING'])
+      timer.time('transition', jira.instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_PLANNING'])
       self.log.msg("Transitioned {} to planning".format(task.key))
-      env = Environment(loader=ObjectLoader())
-      for num in range(0, min(len(update_members), batch_size)):
-        m = update_members.pop()
-        filename = '{}.{}.template'.format(m.pool.id, m.vm_id)
-        attachment_content = io.StringIO(m.current_template())
-        jira.instance.add_attachment(
-          issue=task,
-          filename=filename,
-          attachment=attachment_content)
-        self.log.msg("Attached template for {} to task {}".format(filename, task.key))
-      jira.instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_WRITTEN'])
+      batch = [update_members.pop() for num in range(0, min(len(update_members), batch_size))]
+      filenames = ['{}.{}.template'.format(pool.id, m.vm_id) for m in batch]
+      vm_templates = render_templates(pool, [m.vm.name if m.vm is not None else m.vm_name for m in batch], timer)
+      upload_attachments(self.log, task, pool, [
+        (filename, vm_template, "Attached template for {} to task {}".format(filename, task.key))
+        for filename, vm_template in zip(filenames, vm_templates)], timer)
+      timer.time('transition', jira.instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_WRITTEN'])
       self.log.msg("Transitioned task {} to written".format(task.key))
-      jira.approver_instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_APPROVED'])
+      timer.time('transition', jira.approver_instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_APPROVED'])
       self.log.msg("Approved task {}".format(task.key))
-    jira.instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_PLANNED_CHANGE'])
+    timer.time('transition', jira.instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_PLANNED_CHANGE'])
     self.log.msg("Transitioned change request {} to approved".format(task.key))
-    jira.approver_instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_APPROVED'])
+    timer.time('transition', jira.approver_instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_APPROVED'])
     self.log.msg("Transitioned change request {} to approved".format(crq.key))
     self.log.msg("Task ID {}".format(self.task.id))
+    self.log.msg("Planning took {}".format(timer))
     db_ticket = PoolTicket(
       pool=pool,
       action_id=PoolTicketActions.update.value,
@@ -159,6 +238,7 @@ def plan_update(self, pool, update_members):
 
 def plan_shrink(self, pool, shrink_members):
   task = crq = None
+  timer = PhaseTimer()
   try:
     pool = Session.merge(pool)
     start, end = jira.next_immediate_window_dates()
@@ -177,7 +257,7 @@ def plan_shrink(self, pool, shrink_members):
       customfield_14135={'value': 'IPG', 'child': {'value': 'IPG Big Data'}},
       customfield_17679="Pool shrink required")
     self.log.msg("Created change request: {}".format(crq.key))
-    jira.instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_PLANNING'])
+    timer.time('transition', jira.instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_PLANNING'])
     self.log.msg("Transitioned {} to planning".format(crq.key))
     jira.instance.create_issue_link('Relate', crq, logging)
     self.log.msg("Related {} to LOGGING service {}".format(crq.key, logging.key))
@@ -190,25 +270,23 @@ def plan_shrink(self, pool, shrink_members):
       customfield_14135={'value': 'IPG', 'child': {'value': 'IPG Big Data'}},
       customfield_15150={'value': 'No'})
     self.log.msg("Created task: {}".format(task.key))
-    jira.instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_PLANNING'])
+    timer.time('transition', jira.instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_PLANNING'])
     self.log.msg("Transitioned {} to planning".format(task.key))
+    attachments = []
     for m in [Session.merge(m) for m in shrink_members]:
       filename = '{}.{}.template'.format(pool.id, m.vm_id)
-      attachment_content = io.StringIO(m.template)
-      jira.instance.add_attachment(
-        issue=task,
-        filename=filename,
-        attachment=attachment_content)
-      self.log.msg("Attached member {} to shrink to task {}".format(filename, task.key))
-    jira.instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_WRITTEN'])
+      attachments.append((filename, m.template, "Attached member {} to shrink to task {}".format(filename, task.key)))
+    upload_attachments(self.log, task, pool, attachments, timer)
+    timer.time('transition', jira.instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_WRITTEN'])
     self.log.msg("Transitioned task {} to written".format(task.key))
-    jira.approver_instance.transition_issue(task, app.config['JIRA_TRANSITION_TASK_APPROVED'])
+    timer.time('transition', jira.approver_instance.transition_issue, task, app.config['JIRA_TRANSITION_TASK_APPROVED'])
     self.log.msg("Approved task {}".format(task.key))
-    jira.instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_PLANNED_CHANGE'])
+    timer.time('transition', jira.instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_PLANNED_CHANGE'])
     self.log.msg("Transitioned task {} to approved".format(task.key))
-    jira.approver_instance.transition_issue(crq, app.config['JIRA_TRANSITION_CRQ_APPROVED'])
+    timer.time('transition', jira.approver_instance.transition_issue, crq, app.config['JIRA_TRANSITION_CRQ_APPROVED'])
     self.log.msg("Transitioned change request {} to approved".format(crq.key))
     self.log.msg("Task ID {}".format(self.task.id))
+    self.log.msg("Planning took {}".format(timer))
     db_ticket = PoolTicket(
       pool=pool,
       action_id=PoolTicketActions.shrink.value,
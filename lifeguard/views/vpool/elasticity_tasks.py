@@ -1,19 +1,23 @@
 from lifeguard.database import Session
-from lifeguard.one import OneProxy
 from lifeguard import jira
 from lifeguard.jira_api import JiraApi
-from lifeguard.views.vpool.models import PoolMembership, PoolTicketActions, PoolMemberDiagnostic
+from lifeguard.views.vpool.models import VirtualMachinePool, PoolMembership, PoolTicketActions, PoolMemberDiagnostic
 from lifeguard.views.vpool.health import Diagnostic
+from lifeguard.views.vpool.template_archive import iter_task_templates, template_host
+from lifeguard.views.vpool.readiness import iter_ready, is_running
 from lifeguard.tasks.retry import retry
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func
 from datetime import datetime
+from itertools import chain
+import random
 from queue import Queue
 from threading import Thread
 from lifeguard import app
-import time
 
 def get_runnable_from_action_id(action_id):
   action_to_runnable = {PoolTicketActions.expand.value: expand,
-                        PoolTicketActions.update.value: update,
+                        PoolTicketActions.update.value: update_pipelined if app.config['UPDATE_PIPELINED'] else update,
                         PoolTicketActions.shrink.value: shrink}
   if action_id not in action_to_runnable:
     raise Exception("Action ID {} is not a supported action to implement".format(action_id))
@@ -65,13 +69,12 @@ def diagnostic_worker(q, results, log):
 def run_diagnostics(members, log):
   """
   Runs diagnotics againts members to determine their health status
-  :param members: The list of members to check health against
+  :param members: The members to check health against, may be a generator
+  that yields them as they become ready, the workers start on the first
   :return: The list of diagnostics ran against the members
   """
   results = []
   q = Queue()
-  for member in members:
-    q.put({'member': member})
   for i in range(app.config['NUM_HEALTH_CHECK_THREADS']):
     t = Thread(target=diagnostic_worker, kwargs={'q': q,
                                                  'results': results,
@@ -79,6 +82,8 @@ def run_diagnostics(members, log):
     log.msg("starting diagnostic worker: #{}".format(i))
     t.daemon = True
     t.start()
+  for member in members:
+    q.put({'member': member})
   q.join()
   return results
 
@@ -87,10 +92,56 @@ def failed_diagnostics(diagnostics):
     if not d.succeeded:
       yield d
 
-def run_diagnostics_on_pool(pool, log):
-  members = pool.get_memberships()
-  results = run_diagnostics(members, log)
-  failures = list(failed_diagnostics(results))
+def check_liveness(member, vm):
+  """
+  A cheap stand in for a diagnostic that only checks ONE has the member's
+  VM running, without connecting to it
+  :param member:
+  :param vm: the member's VirtualMachine as ONE has it now, None if missing
+  :return: Diagnostic
+  """
+  now = datetime.utcnow()
+  running = is_running(vm)
+  return Diagnostic(host=member.vm_name,
+                    cmd='liveness (ONE state)',
+                    stdout='{} {}'.format(vm.state, vm.lcm_state) if vm is not None else 'no VM',
+                    exitcode=0 if running else 1,
+                    start_date=now,
+                    end_date=now,
+                    succedded=running)
+
+def run_diagnostics_on_pool(pool, log, new_members=(), exclude_ids=()):
+  """
+  Runs diagnostics against the pool after a change, new members as soon as
+  they're up (see iter_ready).  With POST_CHANGE_DIAGNOSTICS = 'all' every
+  other member is diagnosed too, with 'targeted' only a random sample of
+  POST_CHANGE_SAMPLE_SIZE of them is and the rest only get a liveness check.
+  :param pool:
+  :param log:
+  :param new_members: members whose VMs were just created
+  :param exclude_ids: VM IDs of members not to diagnose, e.g. those about
+  to be retired
+  :return:
+  """
+  new_ids = {m.vm_id for m in new_members}
+  members = [m for m in pool.get_memberships() if m.vm_id not in new_ids and m.vm_id not in exclude_ids]
+  one_proxy = pool.cluster.zone.get_one_proxy()
+  liveness = []
+  if app.config['POST_CHANGE_DIAGNOSTICS'] == 'targeted':
+    sampled = random.sample(members, min(len(members), app.config['POST_CHANGE_SAMPLE_SIZE']))
+    sampled_ids = {m.vm_id for m in sampled}
+    unsampled = [m for m in members if m.vm_id not in sampled_ids]
+    # the members' vm may be from a cached inventory, their states are
+    # fetched live (in a single multicall) so VMs that died aren't missed
+    vms = one_proxy.get_vms_by_id([m.vm_id for m in unsampled]) if unsampled else {}
+    liveness = [check_liveness(m, vms.get(m.vm_id)) for m in unsampled]
+    log.msg("diagnosing {} new and {} sampled members of pool {}, liveness checked {} others ({} failed)".format(
+      len(new_members), len(sampled), pool.name, len(liveness), len(list(failed_diagnostics(liveness)))))
+    members = sampled
+  ready = iter_ready(one_proxy, new_members, log) if new_members else []
+  # the new members first, then the rest
+  results = run_diagnostics(chain((m for m, in_time in ready), members), log)
+  failures = list(failed_diagnostics(liveness + results))
   if failures:
     title = "{} diagnostics failed for pool {}".format(len(failures), pool.name)
     defect_ticket = jira.defect_for_diagnostics(username="ticket_script",
@@ -100,12 +151,100 @@ def run_diagnostics_on_pool(pool, log):
     comment = "{} failed diagnostics after change".format(len(failures))
     raise Exception(comment)
 
+def retire_members(pool, members, log):
+  """
+  Retires the members' VMs together and deletes the memberships of those
+  that were killed
+  :param pool:
+  :param members:
+  :param log:
+  :return: the members that were retired and an exception describing any
+  that could not be (or None)
+  """
+  outcomes = pool.retire_members(members)
+  retired = []
+  failures = []
+  for member in members:
+    outcome = outcomes[member.vm_id]
+    if outcome.done:
+      Session.delete(member)
+      Session.commit()
+      log.msg("Retired VM {} and removed it as member of pool {}".format(member.vm_id, pool.name))
+      retired.append(member)
+    else:
+      log.err("Failed to retire VM {} of pool {}: {}".format(member.vm_id, pool.name, outcome.error))
+      failures.append(outcome)
+  if failures:
+    return retired, Exception("failed to retire {} of {} VMs: {}".format(
+      len(failures), len(members), ", ".join(str(f.vm_id) for f in failures)))
+  return retired, None
+
+def create_members(pool, one_proxy, templates, log, max_parallel=None):
+  """
+  Instantiates VMs and adds them as members of the pool.  Up to max_parallel
+  VMs are allocated at once and the memberships of each such batch are
+  committed together, a VM that fails to allocate doesn't stop the others.
+  :param pool:
+  :param one_proxy:
+  :param templates: list of vm_name, template, hostname the template was
+  rendered for
+  :param log:
+  :param max_parallel: defaults to INSTANTIATE_MAX_PARALLEL
+  :return: the new members and an exception describing the VMs that could
+  not be created (or None)
+  """
+  if max_parallel is None:
+    max_parallel = app.config['INSTANTIATE_MAX_PARALLEL']
+  max_parallel = max(1, max_parallel)
+
+  def allocate(template):
+    try:
+      return one_proxy.create_vm(template=template), None
+    except Exception as e:
+      return None, e
+
+  created = []
+  failures = []
+  with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+    for start in range(0, len(templates), max_parallel):
+      batch = templates[start:start + max_parallel]
+      results = list(executor.map(allocate, [template for vm_name, template, hostname in batch]))
+      members = []
+      for (vm_name, template, hostname), (vm_id, error) in zip(batch, results):
+        if error is not None:
+          log.err("Failed to instantiate VM {} for pool {}: {}".format(vm_name, pool.name, error))
+          failures.append(vm_name)
+          continue
+        members.append(PoolMembership(pool=pool, vm_name=vm_name, vm_id=vm_id, template=template,
+                                      hostname=hostname, date_added=datetime.utcnow()))
+      for member in members:
+        Session.add(member)
+      Session.commit()
+      for member in members:
+        log.msg("Instantiated new VM {} (ID {}) and added as member of pool {}".format(
+          member.vm_name, member.vm_id, pool.name))
+      created.extend(members)
+  if failures:
+    return created, Exception("failed to instantiate {} of {} VMs: {}".format(
+      len(failures), len(templates), ", ".join(failures)))
+  return created, None
+
+def rendered_hostnames(one_proxy, members):
+  """
+  :param one_proxy:
+  :param members: to be replaced by an update
+  :return: dict of VM ID to the hostname their update templates were
+  rendered for, see plan_update
+  """
+  vms = one_proxy.get_vms_by_id([m.vm_id for m in members])
+  return {m.vm_id: vms[m.vm_id].name if m.vm_id in vms else m.vm_name for m in members}
+
 def expand(self, pool, pool_ticket, issue, cowboy_mode=False):
-  new_vm_ids = []
+  new_members = []
   pool = Session.merge(pool)
   pool_ticket = Session.merge(pool_ticket)
   self.task = Session.merge(self.task)
-  one_proxy = OneProxy(pool.cluster.zone.xmlrpc_uri, pool.cluster.zone.session_string, verify_certs=False)
+  one_proxy = pool.cluster.zone.get_one_proxy()
   try:
     c_start = JiraApi.get_now()
     jira.start_crq(issue, log=self.log, cowboy_mode=cowboy_mode)
@@ -113,19 +252,16 @@ def expand(self, pool, pool_ticket, issue, cowboy_mode=False):
       t_start = JiraApi.get_now()
       t2 = jira.instance.issue(t.key)
       jira.start_task(t2, log=self.log, cowboy_mode=cowboy_mode)
-      for a in t2.fields.attachment:
-        pool_id, vm_name = a.filename.split('.', 2)[:2]
-        template = a.get().decode(encoding="utf-8", errors="strict")
-        vm_id = one_proxy.create_vm(template=template)
-        new_vm_ids.append(vm_id)
-        m = PoolMembership(pool=pool, vm_name=vm_name, vm_id=vm_id, template=a.get(), date_added=datetime.utcnow())
-        Session.merge(m)
-        Session.commit()
-        self.log.msg("created new vm: {}".format(vm_name))
+      templates = []
+      for filename, template in iter_task_templates(t2):
+        pool_id, vm_name = filename.split('.', 2)[:2]
+        templates.append((vm_name, template, template_host(filename)))
+      created, error = create_members(pool, one_proxy, templates, self.log)
+      new_members.extend(created)
+      if error is not None:
+        raise error
       jira.complete_task(t, start_time=t_start, log=self.log, cowboy_mode=cowboy_mode)
-    self.log.msg("waiting for 120 seconds before running post task diagnostics")
-    time.sleep(120)
-    run_diagnostics_on_pool(pool, self.log)
+    run_diagnostics_on_pool(pool, self.log, new_members=new_members)
     jira.complete_crq(issue, start_time=c_start, log=self.log, cowboy_mode=cowboy_mode)
   except Exception as e:
     self.log.err("Error occured: {}".format(e))
@@ -147,16 +283,14 @@ def shrink(self, pool, pool_ticket, issue, cowboy_mode=False):
       t_start = JiraApi.get_now()
       t2 = jira.instance.issue(t.key)
       jira.start_task(t2, log=self.log, cowboy_mode=cowboy_mode)
-      for a in t2.fields.attachment:
-        pool_id, vm_id = a.filename.split('.', 2)[:2]
-        member = PoolMembership.query.filter_by(pool=pool, vm_id=vm_id).first()
-        member.retire()
-        Session.delete(member)
-        Session.commit()
-        self.log.msg("Retired VM {} and removed it as member of pool {}".format(member.vm_id, pool.name))
+      members = []
+      for filename, template in iter_task_templates(t2, names_only=True):
+        pool_id, vm_id = filename.split('.', 2)[:2]
+        members.append(PoolMembership.query.filter_by(pool=pool, vm_id=vm_id).first())
+      retired, error = retire_members(pool, members, self.log)
+      if error is not None:
+        raise error
       jira.complete_task(t, start_time=t_start, log=self.log, cowboy_mode=cowboy_mode)
-    self.log.msg("waiting for 120 seconds before running post task diagnostics")
-    time.sleep(120)
     run_diagnostics_on_pool(pool, self.log)
     jira.complete_crq(issue, start_time=c_start, log=self.log, cowboy_mode=cowboy_mode)
   except Exception as e:
@@ -172,7 +306,7 @@ def update(self, pool, pool_ticket, issue, cowboy_mode=False):
   pool = Session.merge(pool)
   pool_ticket = Session.merge(pool_ticket)
   self.task = Session.merge(self.task)
-  one_proxy = OneProxy(pool.cluster.zone.xmlrpc_uri, pool.cluster.zone.session_string, verify_certs=False)
+  one_proxy = pool.cluster.zone.get_one_proxy()
   try:
     c_start = JiraApi.get_now()
     jira.start_crq(issue, log=self.log, cowboy_mode=cowboy_mode)
@@ -181,23 +315,26 @@ def update(self, pool, pool_ticket, issue, cowboy_mode=False):
       t2 = jira.instance.issue(t.key)
       jira.start_task(t2, log=self.log, cowboy_mode=cowboy_mode)
       updated_members = []
-      for a in t2.fields.attachment:
-        pool_id, vm_id = a.filename.split('.', 2)[:2]
-        template = a.get().decode(encoding="utf-8", errors="strict")
+      members = []
+      templates = {}
+      for filename, template in iter_task_templates(t2):
+        pool_id, vm_id = filename.split('.', 2)[:2]
         member = PoolMembership.query.filter_by(pool=pool, vm_id=vm_id).first()
-        vm_name = member.vm_name
-        member.retire()
-        Session.delete(member)
-        Session.commit()
-        new_id = one_proxy.create_vm(template=template)
-        new_member = PoolMembership(pool=pool, vm_name=vm_name, vm_id=new_id, template=template, date_added=datetime.utcnow())
-        Session.add(new_member)
-        Session.commit()
-        self.log.msg("Instantiated new VM ID {} and added as member of pool {}".format(new_member.vm_id, pool.name))
-        updated_members.append(new_member)
-      self.log.msg("waiting for 120 seconds before running post change diagnostics")
-      time.sleep(120)
-      run_diagnostics_on_pool(pool, self.log)
+        members.append(member)
+        templates[member.vm_id] = template
+      hostnames = rendered_hostnames(one_proxy, members)
+      # the whole task's VMs are retired together, the ones that were are
+      # replaced before any failure is raised
+      retired, error = retire_members(pool, members, self.log)
+      created, create_error = create_members(
+        pool, one_proxy, [(member.vm_name, templates[member.vm_id], hostnames[member.vm_id])
+                          for member in retired], self.log)
+      updated_members.extend(created)
+      if error is not None:
+        raise error
+      if create_error is not None:
+        raise create_error
+      run_diagnostics_on_pool(pool, self.log, new_members=updated_members)
       jira.complete_task(t, start_time=t_start, log=self.log, cowboy_mode=cowboy_mode)
     jira.complete_crq(issue, start_time=c_start, log=self.log, cowboy_mode=cowboy_mode)
   except Exception as e:
@@ -207,4 +344,160 @@ def update(self, pool, pool_ticket, issue, cowboy_mode=False):
   finally:
     pool_ticket.done = True
     Session.merge(pool_ticket)
-    Session.commit()
\ No newline at end of file
+    Session.commit()
+
+def fetch_task_templates(pool_id, task_key):
+  """
+  Fetches an update sub-task and its templates, checking they're all for
+  the pool.  Makes no database queries so it can run on another thread.
+  :param pool_id:
+  :param task_key:
+  :return: the task and a list of VM ID, template to replace it with
+  """
+  t2 = jira.instance.issue(task_key)
+  templates = []
+  for filename, template in iter_task_templates(t2):
+    file_pool_id, vm_id = filename.split('.', 2)[:2]
+    if int(file_pool_id) != pool_id:
+      raise Exception("{} attached to {} is not for pool {}".format(filename, task_key, pool_id))
+    if not template.strip():
+      raise Exception("{} attached to {} is empty".format(filename, task_key))
+    templates.append((int(vm_id), template))
+  return t2, templates
+
+def count_healthy(pool, one_proxy, exclude_ids):
+  """
+  Counts the pool's members that ONE has running now and whose latest
+  diagnostic passed
+  :param pool:
+  :param one_proxy:
+  :param exclude_ids: VM IDs of members not to count, e.g. those being
+  replaced or still to pass diagnostics
+  :return:
+  """
+  vm_ids = [m.vm_id for m in PoolMembership.query.filter_by(pool=pool).all() if m.vm_id not in exclude_ids]
+  if not vm_ids:
+    return 0
+  latest_ids = [id for vm_id, id in Session.query(
+    PoolMemberDiagnostic.vm_id, func.max(PoolMemberDiagnostic.id)).filter(
+    PoolMemberDiagnostic.pool_id == pool.id,
+    PoolMemberDiagnostic.vm_id.in_(vm_ids)).group_by(PoolMemberDiagnostic.vm_id).all()]
+  if not latest_ids:
+    return 0
+  passed = [d.vm_id for d in PoolMemberDiagnostic.query.filter(PoolMemberDiagnostic.id.in_(latest_ids)).all()
+            if d.exitcode == 0]
+  vms = one_proxy.get_vms_by_id(passed) if passed else {}
+  return sum(1 for vm_id in passed if is_running(vms.get(vm_id)))
+
+def diagnose_batch(pool_id, log, new_ids, exclude_ids):
+  """
+  run_diagnostics_on_pool for a background thread, the pool and its new
+  members are loaded in the thread's own session
+  :param pool_id:
+  :param log:
+  :param new_ids: VM IDs of the members just created
+  :param exclude_ids: VM IDs of members not to diagnose
+  """
+  try:
+    pool = VirtualMachinePool.query.get(pool_id)
+    new_members = PoolMembership.query.filter(PoolMembership.pool_id == pool_id,
+                                              PoolMembership.vm_id.in_(new_ids)).all() if new_ids else []
+    run_diagnostics_on_pool(pool, log, new_members=new_members, exclude_ids=exclude_ids)
+  finally:
+    Session.remove()
+
+def update_pipelined(self, pool, pool_ticket, issue, cowboy_mode=False):
+  """
+  Implements an update like update does, one sub-task at a time in order,
+  but overlaps the batches: the next sub-task's templates are fetched and
+  checked in the background, and once a batch's replacements are created
+  their readiness wait and diagnostics run in the background while the next
+  batch is retired and replaced.  A batch is only started before the
+  previous one has passed its diagnostics if at least UPDATE_MIN_HEALTHY
+  other members are running and passed their latest diagnostic (see
+  count_healthy), and each sub-task is still only completed once its
+  diagnostics pass.
+  """
+  pool = Session.merge(pool)
+  pool_ticket = Session.merge(pool_ticket)
+  self.task = Session.merge(self.task)
+  one_proxy = pool.cluster.zone.get_one_proxy()
+  min_healthy = app.config['UPDATE_MIN_HEALTHY']
+  subtasks = issue.fields.subtasks
+
+  def finish(batch):
+    t, t_start, diagnostics = batch
+    diagnostics.result()
+    jira.complete_task(t, start_time=t_start, log=self.log, cowboy_mode=cowboy_mode)
+
+  try:
+    c_start = JiraApi.get_now()
+    jira.start_crq(issue, log=self.log, cowboy_mode=cowboy_mode)
+    with ThreadPoolExecutor(max_workers=1) as prefetcher, ThreadPoolExecutor(max_workers=1) as diagnoser:
+      in_flight = None
+      in_flight_ids = set()
+      next_fetch = prefetcher.submit(fetch_task_templates, pool.id, subtasks[0].key) if subtasks else None
+      for i, t in enumerate(subtasks):
+        t2, templates = next_fetch.result()
+        next_fetch = None
+        if i + 1 < len(subtasks):
+          next_fetch = prefetcher.submit(fetch_task_templates, pool.id, subtasks[i + 1].key)
+        members = []
+        for vm_id, template in templates:
+          member = PoolMembership.query.filter_by(pool=pool, vm_id=vm_id).first()
+          if member is None:
+            raise Exception("VM {} to update in {} is not a member of pool {}".format(vm_id, t.key, pool.name))
+          members.append(member)
+        if in_flight is not None:
+          healthy = count_healthy(pool, one_proxy, in_flight_ids | {m.vm_id for m in members})
+          if healthy < min_healthy:
+            self.log.msg("waiting for {} to pass diagnostics, retiring {} more VMs now would leave "
+                         "{} of the minimum {} healthy members".format(
+              in_flight[0].key, len(members), healthy, min_healthy))
+            finish(in_flight)
+            in_flight = None
+        t_start = JiraApi.get_now()
+        jira.start_task(t2, log=self.log, cowboy_mode=cowboy_mode)
+        # the whole task's VMs are retired together, the ones that were are
+        # replaced before any failure is raised
+        hostnames = rendered_hostnames(one_proxy, members)
+        retired, error = retire_members(pool, members, self.log)
+        replacements = dict(templates)
+        created, create_error = create_members(
+          pool, one_proxy, [(member.vm_name, replacements[member.vm_id], hostnames[member.vm_id])
+                            for member in retired], self.log)
+        if error is not None:
+          raise error
+        if create_error is not None:
+          raise create_error
+        # the next batch's members will be retired while this one is
+        # diagnosed, if they can't be fetched this batch is still diagnosed
+        # before the update is stopped
+        next_ids = set()
+        fetch_error = None
+        if next_fetch is not None:
+          try:
+            next_ids = {vm_id for vm_id, template in next_fetch.result()[1]}
+          except Exception as e:
+            fetch_error = e
+        diagnostics = diagnoser.submit(diagnose_batch, pool.id, self.log, [m.vm_id for m in created], next_ids)
+        if in_flight is not None:
+          finish(in_flight)
+        in_flight = (t, t_start, diagnostics)
+        in_flight_ids = {m.vm_id for m in created}
+        if fetch_error is not None:
+          self.log.err("failed to fetch the templates of {}, stopping the update once {} is diagnosed: {}".format(
+            subtasks[i + 1].key, t.key, fetch_error))
+          finish(in_flight)
+          raise fetch_error
+      if in_flight is not None:
+        finish(in_flight)
+    jira.complete_crq(issue, start_time=c_start, log=self.log, cowboy_mode=cowboy_mode)
+  except Exception as e:
+    self.log.err("Error occured: {}".format(e))
+    jira.cancel_crq_and_tasks(issue, comment="an exception occured running this change: {}".format(e))
+    raise e
+  finally:
+    pool_ticket.done = True
+    Session.merge(pool_ticket)
+    Session.commit()
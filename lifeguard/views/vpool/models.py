@@ -3,14 +3,17 @@ from flask_wtf import Form
 from wtforms import TextAreaField, StringField
 from wtforms.validators import InputRequired
 from lifeguard.views.cluster.models import Cluster
-from lifeguard.views.template.models import VarParser, ObjectLoader
-from lifeguard.database import Base, Session
-from lifeguard.one import OneProxy
-from lifeguard.one import INCLUDING_DONE
-from  jinja2 import Environment
-from sqlalchemy import Column, Boolean, Integer, String, Text, ForeignKey, DateTime
-from sqlalchemy.orm import relationship, backref
+from lifeguard.views.template.models import VarParser, TemplateCache
+from lifeguard import app, templates
+from lifeguard.database import Base, Session, engine
+from lifeguard.one.VirtualMachine import VirtualMachine
+from lifeguard.one.Cluster import Cluster as OneCluster
+from sqlalchemy import Column, Boolean, Integer, String, Text, ForeignKey, DateTime, Float, Index
+from datetime import datetime, timedelta
+from sqlalchemy.orm import relationship, backref, joinedload
+from sqlalchemy.sql import or_
 import re
+import hashlib
 from enum import Enum
 from lifeguard.ddns import DdnsAuditor
 from lifeguard.jira_api import JiraApi
@@ -57,22 +60,158 @@ class VirtualMachinePool(Base):
   def __repr__(self):
     self.__str__()
 
-  def get_memberships(self, fetch_vms=True, vm_cache=None):
+  def template_fingerprint(self):
+    """
+    :return: hash of everything a member's template is rendered from other
+    than its hostname: the zone, cluster and pool templates and vars and
+    every other column of the pool, its cluster and zone, which the
+    template can read through the pool it's rendered with
+    """
+    return TemplateCache.key(*[str(getattr(obj, column.key))
+                               for obj in (self.cluster.zone, self.cluster, self)
+                               for column in obj.__table__.columns])
+
+  def outdated_memberships(self, fingerprint=None):
+    """
+    Finds the members whose template was rendered from other zone, cluster
+    or pool templates or vars than the pool's current ones (or from unknown
+    ones) in a single query on the fingerprint index, without rendering
+    anything.  Members whose template renders the same regardless are
+    included, is_current() tells those apart.
+    :param fingerprint: the pool's template_fingerprint(), computed if not given
+    :return: list of PoolMembership objects
+    """
+    if fingerprint is None:
+      fingerprint = self.template_fingerprint()
+    return PoolMembership.query.filter(
+      PoolMembership.pool_id == self.id,
+      # members without a template are outdated, as is_current() has them
+      or_(PoolMembership.template == None,
+          PoolMembership.template != 'not-yet-compiled'),
+      or_(PoolMembership.template_fingerprint == None,
+          PoolMembership.template_fingerprint != fingerprint)).all()
+
+  def compiled_template(self):
+    """
+    :return: the pool's template compiled, shared by every render until the
+    zone, cluster or pool template changes
+    """
+    return templates.get(self.template, self.cluster.zone.template, self.cluster.template)
+
+  def render_template(self, hostname):
+    """
+    Renders the template of a VM in the pool
+    :param hostname:
+    :return:
+    """
+    vars = VarParser.host_vars(
+      self.cluster.zone.vars,
+      self.cluster.vars,
+      self.vars,
+      hostname)
+    return self.compiled_template().render(pool=self, vars=vars)
+
+  @staticmethod
+  def load_all_with_memberships():
+    """
+    Loads every pool along with its cluster and zone in one joined query and
+    the memberships of all pools in a second, rather than lazy loading the
+    cluster, zone and memberships of each pool in turn
+    :return: list of pools, dict of pool ID to the pool's PoolMembership objects
+    """
+    pools = Session.query(VirtualMachinePool).options(
+      joinedload(VirtualMachinePool.cluster).joinedload(Cluster.zone)).all()
+    memberships = {pool.id: [] for pool in pools}
+    for m in PoolMembership.query.all():
+      if m.pool_id in memberships:
+        memberships[m.pool_id].append(m)
+    return pools, memberships
+
+  def get_memberships(self, fetch_vms=True, vm_cache=None, memberships=None):
     """
     Get the PoolMembership objects that are associated with the pool
     :param fetch_vms: If true, the vm attribute will be populated (incurs potentially
-    timely call to the ONE api
+    timely call to the ONE api when the zone's VM inventory is not cached)
+    :param vm_cache: VMs keyed by ID to use instead of looking them up
+    :param memberships: the pool's memberships if already loaded, e.g. by
+    load_all_with_memberships
     :return:
     """
-    memberships =  PoolMembership.query.filter_by(pool=self).all()
+    if memberships is None:
+      memberships = PoolMembership.query.filter_by(pool=self).all()
     if fetch_vms:
-      one_proxy = OneProxy(self.cluster.zone.xmlrpc_uri, self.cluster.zone.session_string, verify_certs=False)
       if vm_cache is None:
-        vm_cache = {vm.id: vm for vm in one_proxy.get_vms(INCLUDING_DONE)}
+        vm_cache = self.lookup_vms([m.vm_id for m in memberships])
       for m in memberships:
-        m.vm = vm_cache[m.vm_id]
+        m.vm = vm_cache.get(m.vm_id)
+        if m.vm is None:
+          m.vm = VirtualMachine.vanished_placeholder(m.vm_id, m.vm_name)
     return memberships
 
+  def lookup_vms(self, vm_ids):
+    """
+    Picks the cheapest way of fetching the given VMs: the zone's cached
+    inventory when it is fresh, the vm_inventory table when it was refreshed
+    within VM_INVENTORY_MAX_AGE_S, otherwise targeted one.vm.info calls
+    (batched into multicalls, which beat a paged dump of the zone until a
+    pool is most of its zone, see bench_lookup_strategy).  VMs missing from
+    the cache or table are looked up live, see _with_missing_vms
+    :param vm_ids:
+    :return: dict of VM ID to VirtualMachine, missing VMs are omitted
+    """
+    zone = self.cluster.zone
+    vms = zone.get_vm_inventory(load=False)
+    if vms is not None:
+      return self._with_missing_vms(vms, vm_ids)
+    if VmInventoryRefresh.as_of(zone.number) is not None:
+      return self._with_missing_vms(VmInventory.get_vms(zone.number, vm_ids), vm_ids)
+    return zone.get_one_proxy().get_vms_by_id(vm_ids)
+
+  def _with_missing_vms(self, vms, vm_ids):
+    """
+    Looks up the VMs missing from an inventory read earlier with targeted
+    one.vm.info calls, so those created since (e.g. by another process)
+    aren't taken to have vanished
+    :param vms: dict of VM ID to VirtualMachine, not modified
+    :param vm_ids:
+    :return: dict of VM ID to VirtualMachine for vm_ids, VMs missing from
+    ONE too are omitted
+    """
+    missing = [id for id in vm_ids if id not in vms]
+    if not missing:
+      return vms
+    found = {id: vms[id] for id in vm_ids if id in vms}
+    found.update(self.cluster.zone.get_one_proxy().get_vms_by_id(missing))
+    return found
+
+  def retire_members(self, members):
+    """
+    Removes the members' IPs from the pool's DNS record then kills all their
+    VMs together, waiting for them to be DONE (see OneProxy.kill_vms).  The
+    memberships themselves are left for the caller to delete.
+    :param members: PoolMembership objects of this pool
+    :return: dict of VM ID to KillOutcome
+    """
+    vm_ids = [m.vm_id for m in members]
+    one_proxy = self.cluster.zone.get_one_proxy()
+    vms = one_proxy.get_vms_by_id(vm_ids)
+    ddns_api = self.cluster.zone.get_ddns_api()
+    for vm in vms.values():
+      ddns_api.delete_ip_from_pool_record(self, vm.ip_address)
+      logging.info("removed ip address {} member of pool {}".format(vm.ip_address, self.name))
+    return one_proxy.kill_vms(vm_ids)
+
+  def inventory_as_of(self):
+    """
+    :return: when the VMs shown for the pool were read from ONE, None if
+    they are fetched live
+    """
+    zone = self.cluster.zone
+    age_seconds = zone.get_vm_inventory_age()
+    if age_seconds is not None:
+      return datetime.utcnow() - timedelta(seconds=age_seconds)
+    return VmInventoryRefresh.as_of(zone.number)
+
   def name_for_number(self, number):
     pattern = re.compile("^([^\.]+)\.(.*)$")
     match = pattern.match(self.name)
@@ -80,12 +219,30 @@ class VirtualMachinePool(Base):
       raise Exception("Failed to parse pool name for hostname of number: {}".format(number))
     return '{}{}.{}'.format(match.group(1), number, match.group(2))
 
-  def num_outdated_vms(self, members):
-    num = 0
+  def outdated_members(self, members):
+    """
+    Finds the outdated members, only rendering the candidates found by
+    outdated_memberships().  Those found current by rendering have the
+    pool's fingerprint recorded so later checks don't render them again.
+    :param members: the pool's members
+    :return: those whose template isn't what the pool renders for them now
+    """
+    fingerprint = self.template_fingerprint()
+    candidate_ids = {m.vm_id for m in self.outdated_memberships(fingerprint)}
+    outdated = []
+    confirmed_ids = []
     for m in members:
-      if not m.is_current():
-        num += 1
-    return num
+      if m.vm_id not in candidate_ids:
+        continue
+      if m.is_current(fingerprint):
+        confirmed_ids.append(m.vm_id)
+      else:
+        outdated.append(m)
+    PoolMembership.record_fingerprint(self.id, confirmed_ids, fingerprint)
+    return outdated
+
+  def num_outdated_vms(self, members):
+    return len(self.outdated_members(members))
 
   def num_legacy_vms(self, members):
     num = 0
@@ -152,17 +309,16 @@ class VirtualMachinePool(Base):
 
   def get_update_members(self, members, form_update_ids=None):
     update_members = []
-    for m in members:
-      if not m.is_current():
-        if form_update_ids is not None:
-          if str(m.vm.id) in form_update_ids:
-            update_members.append(m)
-          else:
-            raise Exception("A VM was determined to require and update "
-                            "however it was not present in earlier form "
-                            "submission (try re-submitting again)")
-        else:
+    for m in self.outdated_members(members):
+      if form_update_ids is not None:
+        if str(m.vm.id) in form_update_ids:
           update_members.append(m)
+        else:
+          raise Exception("A VM was determined to require and update "
+                          "however it was not present in earlier form "
+                          "submission (try re-submitting again)")
+      else:
+        update_members.append(m)
     return update_members
 
   def pending_ticket(self):
@@ -195,15 +351,67 @@ class PoolMembership(Base):
   pool = relationship('VirtualMachinePool', backref=backref('virtual_machine_pool', lazy='dynamic'))
   date_added = Column(DateTime, nullable=False)
   template = Column(Text(), default='not-yet-compiled')
-
-  def __init__(self, pool_id=None, pool=None, vm_id=None, vm_name=None, date_added=None, vm=None, template=None):
+  # sha256 of template
+  template_hash = Column(String(64))
+  # the pool's template_fingerprint() when template was what it rendered for
+  # this VM, None if that's not known
+  template_fingerprint = Column(String(64))
+  __table_args__ = (Index('ix_pool_membership_pool_fingerprint', 'pool_id', 'template_fingerprint'),)
+
+  def __init__(self, pool_id=None, pool=None, vm_id=None, vm_name=None, date_added=None, vm=None, template=None,
+               hostname=None):
     self.pool_id = pool_id
     self.pool = pool
     self.vm_id = vm_id
-    self.vm_name = vm_name,
+    self.vm_name = vm_name
     self.date_added = date_added
     self.vm = vm
     self.template = template
+    if template is not None:
+      self.set_template(template, hostname)
+
+  @staticmethod
+  def hash_template(template):
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()
+
+  def set_template(self, template, hostname=None):
+    """
+    Records the template the VM was instantiated from along with its hash
+    and, if it is what the pool renders for the VM now, the pool's template
+    fingerprint so later drift checks only compare fingerprints
+    :param template: str, or the bytes of a downloaded attachment
+    :param hostname: the template was rendered for, defaults to the VM's name
+    :return:
+    """
+    if isinstance(template, bytes):
+      template = template.decode(encoding="utf-8", errors="strict")
+    self.template = template
+    self.template_hash = PoolMembership.hash_template(template)
+    self.template_fingerprint = None
+    if self.pool is not None:
+      fingerprint = self.pool.template_fingerprint()
+      current = self.pool.render_template(hostname) if hostname is not None else self.current_template()
+      if template == current:
+        self.template_fingerprint = fingerprint
+
+  @staticmethod
+  def record_fingerprint(pool_id, vm_ids, fingerprint):
+    """
+    Records the pool's template fingerprint for members whose template was
+    found to be what it renders now.  Written in its own transaction so the
+    caller's session (and the memberships loaded in it) is left alone, e.g.
+    while a page is rendered.
+    :param pool_id:
+    :param vm_ids:
+    :param fingerprint:
+    :return:
+    """
+    if not vm_ids:
+      return
+    table = PoolMembership.__table__
+    with engine.begin() as connection:
+      connection.execute(table.update().where(
+        (table.c.pool_id == pool_id) & table.c.vm_id.in_(vm_ids)).values(template_fingerprint=fingerprint))
 
   def remove_cmd(self):
     if self.is_done():
@@ -212,31 +420,34 @@ class PoolMembership(Base):
       return "shutdown"
 
   def retire(self):
-    one_proxy = OneProxy(self.pool.cluster.zone.xmlrpc_uri, self.pool.cluster.zone.session_string, verify_certs=False)
-    vm = one_proxy.get_vm(self.vm_id)
-    ip = vm.ip_address
-    self.pool.cluster.zone.get_ddns_api().delete_ip_from_pool_record(self.pool, ip)
-    one_proxy.kill_vm(self.vm_id)
-    logging.info("removed ip address {} member of pool {}".format(ip, self.pool.name))
+    outcome = self.pool.retire_members([self])[self.vm_id]
+    if not outcome.done:
+      raise Exception("failed to retire VM {} of pool {}: {}".format(self.vm_id, self.pool.name, outcome.error))
 
   def is_done(self):
     if self.vm.state_id >= 4:
       return True
 
   def current_template(self):
-    env = Environment(loader=ObjectLoader())
-    vars =  VarParser.parse_kv_strings_to_dict(
-      self.pool.cluster.zone.vars,
-      self.pool.cluster.vars,
-      self.pool.vars,
-      'hostname={}'.format(self.vm.name))
-    return env.from_string(self.pool.template).render(pool=self.pool, vars=vars)
-
-  def is_current(self):
-    try:
-      return self.template == self.current_template() or self.template == 'not-yet-compiled'
-    except Exception as e:
-      raise e
+    return self.pool.render_template(self.vm.name if self.vm is not None else self.vm_name)
+
+  def is_current(self, fingerprint=None):
+    """
+    :param fingerprint: the pool's template_fingerprint(), computed if not
+    given, pass it in when checking many members of the pool
+    :return: True if the VM's template is what the pool renders for it now,
+    without rendering anything if the pool's inputs are unchanged since
+    """
+    if self.template == 'not-yet-compiled':
+      return True
+    if fingerprint is None:
+      fingerprint = self.pool.template_fingerprint()
+    if self.template_fingerprint is not None and self.template_fingerprint == fingerprint:
+      return True
+    current = self.current_template()
+    if self.template_hash is not None:
+      return self.template_hash == PoolMembership.hash_template(current)
+    return self.template == current
 
   @staticmethod
   def get_all(zone):
@@ -265,6 +476,155 @@ class PoolMembership(Base):
     self.__str__()
 
 
+class VmInventory(Base):
+  """
+  A local read model of every VM in each zone, kept up to date by the
+  refresh_inventory script so pages can be rendered without calling ONE
+  """
+  __tablename__ = 'vm_inventory'
+  zone_number = Column(Integer, primary_key=True)
+  vm_id = Column(Integer, primary_key=True)
+  name = Column(String(255), nullable=False, index=True)
+  state_id = Column(Integer, nullable=False)
+  lcm_state_id = Column(Integer, nullable=False)
+  stime = Column(Integer)
+  memory = Column(Integer)
+  cpu = Column(Float)
+  vcpu = Column(Float)
+  cluster_id = Column(Integer)
+  cluster_name = Column(String(100))
+  disk_datastore_id = Column(Integer)
+  disk_datastore_name = Column(String(255))
+  image_id = Column(Integer)
+  image_name = Column(String(255))
+  ip_address = Column(String(45), index=True)
+  template_id = Column(Integer)
+  updated_at = Column(DateTime, nullable=False)
+  __table_args__ = (Index('ix_vm_inventory_zone_cluster_state', 'zone_number', 'cluster_id', 'state_id'),)
+
+  @staticmethod
+  def mapping_for_vm(zone_number, vm, updated_at):
+    return {'zone_number': zone_number,
+            'vm_id': vm.id,
+            'name': vm.name,
+            'state_id': vm.state_id,
+            'lcm_state_id': vm.lcm_state_id,
+            'stime': vm.stime,
+            'memory': vm.memory,
+            'cpu': vm.cpu,
+            'vcpu': vm.vcpu,
+            'cluster_id': vm.disk_cluster_id,
+            'cluster_name': vm.disk_cluster.name if vm.disk_cluster is not None else None,
+            'disk_datastore_id': vm.disk_datastore_id,
+            'disk_datastore_name': vm.disk_datastore_name,
+            'image_id': vm.image_id,
+            'image_name': vm.image_name,
+            'ip_address': vm.ip_address,
+            'template_id': vm.template_id,
+            'updated_at': updated_at}
+
+  def to_vm(self):
+    return VirtualMachine(
+      id=self.vm_id,
+      name=self.name,
+      state=VirtualMachine.state_by_id(self.state_id),
+      state_id=self.state_id,
+      lcm_state=VirtualMachine.lcm_state_by_id(self.lcm_state_id),
+      lcm_state_id=self.lcm_state_id,
+      stime=self.stime,
+      memory=self.memory,
+      cpu=self.cpu,
+      vcpu=self.vcpu,
+      disk_cluster=OneCluster(self.cluster_id, self.cluster_name) if self.cluster_id is not None else None,
+      disk_cluster_id=self.cluster_id,
+      disk_datastore_id=self.disk_datastore_id,
+      disk_datastore_name=self.disk_datastore_name,
+      image_name=self.image_name,
+      image_id=self.image_id,
+      ip_address=self.ip_address,
+      template_id=self.template_id)
+
+  @staticmethod
+  def get_vms(zone_number, vm_ids):
+    """
+    :param zone_number:
+    :param vm_ids:
+    :return: dict of VM ID to VirtualMachine, VMs not in the table are omitted
+    """
+    if not vm_ids:
+      return {}
+    rows = Session.query(VmInventory).filter(
+      VmInventory.zone_number == zone_number,
+      VmInventory.vm_id.in_(vm_ids)).all()
+    return {row.vm_id: row.to_vm() for row in rows}
+
+  @staticmethod
+  def get_cluster_vms(zone_number, cluster_id, include_done=False):
+    """
+    :return: the cluster's VMs sorted by name
+    """
+    query = Session.query(VmInventory).filter(
+      VmInventory.zone_number == zone_number,
+      VmInventory.cluster_id == cluster_id)
+    if not include_done:
+      query = query.filter(VmInventory.state_id != 6)
+    return [row.to_vm() for row in query.order_by(VmInventory.name).all()]
+
+  @staticmethod
+  def apply(zone_number, delta, snapshot, full=False):
+    """
+    Brings the zone's rows up to date with an InventoryDelta, rewriting all
+    of them from the snapshot on the zone's first sync or when full is set
+    :param zone_number:
+    :param delta: InventoryDelta
+    :param snapshot: dict of VM ID to VirtualMachine the delta led to
+    :param full:
+    :return:
+    """
+    now = datetime.utcnow()
+    if full or delta.initial:
+      Session.query(VmInventory).filter(VmInventory.zone_number == zone_number).delete(synchronize_session=False)
+      Session.bulk_insert_mappings(
+        VmInventory, [VmInventory.mapping_for_vm(zone_number, vm, now) for vm in snapshot.values()])
+    else:
+      removed_ids = [vm.id for vm in delta.removed]
+      if removed_ids:
+        Session.query(VmInventory).filter(
+          VmInventory.zone_number == zone_number,
+          VmInventory.vm_id.in_(removed_ids)).delete(synchronize_session=False)
+      changed = {vm.id: vm for vm in delta.added + delta.state_changed + delta.template_changed}
+      for vm in changed.values():
+        Session.merge(VmInventory(**VmInventory.mapping_for_vm(zone_number, vm, now)))
+    Session.merge(VmInventoryRefresh(zone_number=zone_number, refreshed_at=now, num_vms=len(snapshot)))
+    Session.commit()
+
+
+class VmInventoryRefresh(Base):
+  __tablename__ = 'vm_inventory_refresh'
+  zone_number = Column(Integer, primary_key=True)
+  refreshed_at = Column(DateTime, nullable=False)
+  num_vms = Column(Integer, nullable=False)
+
+  def __init__(self, zone_number=None, refreshed_at=None, num_vms=None):
+    self.zone_number = zone_number
+    self.refreshed_at = refreshed_at
+    self.num_vms = num_vms
+
+  @staticmethod
+  def as_of(zone_number):
+    """
+    :param zone_number:
+    :return: when the zone's vm_inventory rows were last refreshed, None if
+    never or longer than VM_INVENTORY_MAX_AGE_S ago
+    """
+    refresh = Session.query(VmInventoryRefresh).get(zone_number)
+    if refresh is None:
+      return None
+    if datetime.utcnow() - refresh.refreshed_at > timedelta(seconds=app.config['VM_INVENTORY_MAX_AGE_S']):
+      return None
+    return refresh.refreshed_at
+
+
 class PoolMemberDiagnostic(Base):
   __tablename__ = 'pool_member_diagnostics'
   id = Column(Integer, primary_key=True)
@@ -0,0 +1,70 @@
+import socket
+import time
+from lifeguard import app
+
+# a VM is up once ONE has it ACTIVE and its LCM state is RUNNING
+ACTIVE = 3
+RUNNING = 3
+
+def is_running(vm):
+  """
+  :param vm: VirtualMachine, or None if it doesn't exist
+  :return: True if ONE has the VM ACTIVE and RUNNING
+  """
+  return vm is not None and vm.state_id == ACTIVE and vm.lcm_state_id == RUNNING
+
+def resolves(hostname):
+  """
+  :param hostname:
+  :return: True if hostname resolves
+  """
+  try:
+    socket.getaddrinfo(hostname, None)
+    return True
+  except socket.gaierror:
+    return False
+
+def iter_ready(one_proxy, members, log, timeout_s=None, poll_s=None, dns_delay_s=None):
+  """
+  Polls the members' VMs until ONE reports them RUNNING and their hostnames
+  resolve, yielding each member as soon as it is.  A hostname is only looked
+  up once its VM has been RUNNING for dns_delay_s, so resolvers don't cache
+  it as missing before the guest has registered it.  Members still not
+  ready after timeout_s are logged and yielded anyway so whatever runs next
+  (e.g. diagnostics) reports them.
+  :param one_proxy: for the zone of the members
+  :param members: PoolMembership objects
+  :param log:
+  :param timeout_s: defaults to READINESS_TIMEOUT_S
+  :param poll_s: seconds between polls, defaults to READINESS_POLL_S
+  :param dns_delay_s: defaults to READINESS_DNS_DELAY_S
+  :return: generator of member, True if it became ready in time
+  """
+  timeout_s = app.config['READINESS_TIMEOUT_S'] if timeout_s is None else timeout_s
+  poll_s = app.config['READINESS_POLL_S'] if poll_s is None else poll_s
+  dns_delay_s = app.config['READINESS_DNS_DELAY_S'] if dns_delay_s is None else dns_delay_s
+  start = time.monotonic()
+  pending = {m.vm_id: m for m in members}
+  running_since = {}
+  while pending:
+    vms = one_proxy.get_vms_by_id(list(pending))
+    for vm_id in list(pending):
+      if not is_running(vms.get(vm_id)):
+        continue
+      running_since.setdefault(vm_id, time.monotonic())
+      if time.monotonic() - running_since[vm_id] < dns_delay_s:
+        continue
+      if not resolves(pending[vm_id].vm_name):
+        continue
+      member = pending.pop(vm_id)
+      log.msg("{} is running and resolves after {:.0f} seconds".format(member.vm_name, time.monotonic() - start))
+      yield member, True
+    if not pending:
+      break
+    elapsed = time.monotonic() - start
+    if elapsed >= timeout_s:
+      for member in pending.values():
+        log.err("{} was not running and resolving after {} seconds".format(member.vm_name, timeout_s))
+        yield member, False
+      break
+    time.sleep(min(poll_s, timeout_s - elapsed))
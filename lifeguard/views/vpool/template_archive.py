@@ -0,0 +1,101 @@
+"""
+The templates attached to a change's tasks, either one attachment per host
+(<pool_id>.<host>.template) or, when ATTACHMENT_ARCHIVE is set, a single
+<pool_id>.templates.tar.gz per task holding a manifest followed by the
+same per host files.  Readers handle both so changes planned before the
+setting was flipped can still be implemented.
+"""
+import hashlib
+import io
+import json
+import tarfile
+
+ARCHIVE_SUFFIX = '.templates.tar.gz'
+MANIFEST_NAME = 'manifest.json'
+
+
+def archive_filename(pool_id):
+  return '{}{}'.format(pool_id, ARCHIVE_SUFFIX)
+
+
+def is_archive(filename):
+  return filename.endswith(ARCHIVE_SUFFIX)
+
+
+def template_host(filename):
+  """
+  :param filename: <pool_id>.<host>.template
+  :return: the host, a hostname or VM ID
+  """
+  return filename.split('.', 1)[1][:-len('.template')]
+
+
+def _add_file(tar, name, data):
+  info = tarfile.TarInfo(name=name)
+  info.size = len(data)
+  tar.addfile(info, io.BytesIO(data))
+
+
+def pack_templates(templates):
+  """
+  :param templates: list of filename, template text (None is packed as an
+  empty file, e.g. for members assigned to the pool without a template)
+  :return: bytes of a gzipped tar with the manifest as its first entry
+  """
+  encoded = [(filename, (template or '').encode('utf-8')) for filename, template in templates]
+  manifest = {'templates': [{'filename': filename,
+                             'size': len(data),
+                             'sha256': hashlib.sha256(data).hexdigest()} for filename, data in encoded]}
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+    _add_file(tar, MANIFEST_NAME, json.dumps(manifest, indent=2).encode('utf-8'))
+    for filename, data in encoded:
+      _add_file(tar, filename, data)
+  return buf.getvalue()
+
+
+def iter_archive(data, names_only=False):
+  """
+  Streams the templates out of an archive made by pack_templates, checking
+  each against the manifest
+  :param data: bytes of the archive
+  :param names_only: only read the manifest
+  :return: generator of filename, template text (None if names_only)
+  """
+  with tarfile.open(fileobj=io.BytesIO(data), mode='r|gz') as tar:
+    entries = iter(tar)
+    first = next(entries, None)
+    if first is None or first.name != MANIFEST_NAME:
+      raise Exception("template archive does not start with {}".format(MANIFEST_NAME))
+    expected = {t['filename']: t for t in json.loads(tar.extractfile(first).read().decode('utf-8'))['templates']}
+    if names_only:
+      for filename in expected:
+        yield filename, None
+      return
+    for entry in entries:
+      if entry.name not in expected:
+        raise Exception("template archive entry {} is not in its manifest".format(entry.name))
+      data = tar.extractfile(entry).read()
+      if hashlib.sha256(data).hexdigest() != expected.pop(entry.name)['sha256']:
+        raise Exception("template archive entry {} does not match its manifest".format(entry.name))
+      yield entry.name, data.decode(encoding="utf-8", errors="strict")
+    if expected:
+      raise Exception("template archive is missing {}".format(", ".join(expected)))
+
+
+def iter_task_templates(task, names_only=False):
+  """
+  Downloads each of the task's attachments once and yields the templates in them
+  :param task: Jira issue with its attachments
+  :param names_only: don't download per host attachments, only the
+  filenames are needed
+  :return: generator of filename, template text (None if names_only)
+  """
+  for a in task.fields.attachment:
+    if is_archive(a.filename):
+      for filename, template in iter_archive(a.get(), names_only):
+        yield filename, template
+    elif names_only:
+      yield a.filename, None
+    else:
+      yield a.filename, a.get().decode(encoding="utf-8", errors="strict")
@@ -4,7 +4,6 @@ from lifeguard.views.zone.models import Zone, ZoneForm, ZoneTemplateForm
 from lifeguard.views.cluster.models import Cluster
 from lifeguard.views.common.models import ActionForm
 from lifeguard.database import Session
-from lifeguard.one import OneProxy
 
 zone_bp = Blueprint('zone_bp', __name__, template_folder='templates')
 
@@ -112,8 +111,8 @@ def delete(zone_number):
 def discover(zone_number):
   zone = Zone.query.get(zone_number)
   clusters = Cluster.query.filter_by(zone=zone).all()
-  one_proxy = OneProxy(zone.xmlrpc_uri, zone.session_string, verify_certs=False)
-  one_clusters = one_proxy.get_clusters()
+  one_proxy = zone.get_one_proxy()
+  one_clusters = one_proxy.get_clusters(refresh=True)
   for one_cluster in one_clusters:
     existing_cluster = Cluster.query.filter_by(zone_number=zone.number, id=one_cluster.id).first()
     if existing_cluster is None:
@@ -1,9 +1,12 @@
 from flask_wtf import Form
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import InputRequired
+from lifeguard import app, vm_inventory, cluster_maps, inventory_sync
 from lifeguard.database import Base
 from sqlalchemy import Column, Integer, String, Text
 from lifeguard.ddns import DdnsAuditor
+from lifeguard.one import OneProxy
+from lifeguard.one.transport import get_pool
 
 class Zone(Base):
   __tablename__ = 'zone'
@@ -57,6 +60,66 @@ class Zone(Base):
   def get_ddns_api(self):
     return DdnsAuditor(zone=self)
 
+  def get_one_proxy(self):
+    """
+    Returns a OneProxy for the zone that invalidates the zone's cached VM
+    inventory whenever it creates or actions a VM, shares the process
+    wide cache of the zone's clusters and batches concurrent VM lookups
+    into multicalls when ONE_BATCH_WINDOW_S is set
+    :return:
+    """
+    number = self.number
+    return OneProxy(self.xmlrpc_uri, self.session_string, verify_certs=False,
+                    on_change=lambda: vm_inventory.invalidate(number),
+                    cluster_cache=cluster_maps,
+                    batch_window_s=app.config['ONE_BATCH_WINDOW_S'])
+
+  def get_vm_inventory(self, load=True):
+    """
+    Returns all VMs in the zone (including DONE) keyed by VM ID from the
+    process wide inventory cache, only calling ONE if the cached copy is
+    missing, older than VM_INVENTORY_CACHE_TTL_S or has been invalidated.
+    The VMs are shared between requests and must not be modified.  Loading
+    the inventory doesn't move the zone's sync snapshot on, only
+    sync_vm_inventory does, so no change is hidden from its callers.
+    :param load: if False None is returned instead of loading the inventory
+    :return:
+    """
+    if not load:
+      return vm_inventory.peek(self.number)
+    return vm_inventory.get(self.number, lambda: {vm.id: vm for vm in self._iter_vms()})
+
+  def _iter_vms(self):
+    return self.get_one_proxy().iter_vms(include_done=True, page_size=app.config['ONE_VMPOOL_PAGE_SIZE'])
+
+  def sync_vm_inventory(self):
+    """
+    Fetches all VMs in the zone (including DONE), working out what changed
+    since the last sync (see InventorySync) and refreshing the cached
+    inventory
+    :return: InventoryDelta, the VMs it was worked out from keyed by ID
+    """
+    delta = inventory_sync.sync(self.number, self._iter_vms())
+    vms = inventory_sync.snapshot(self.number)
+    vm_inventory.put(self.number, vms)
+    return delta, vms
+
+  def get_vm_inventory_age(self):
+    """
+    :return: seconds since the cached inventory was loaded, None if it is
+    missing or has expired
+    """
+    return vm_inventory.fresh_age(self.number)
+
+  def get_vm_inventory_stats(self):
+    return vm_inventory.stats(self.number)
+
+  def get_cluster_map_stats(self):
+    return cluster_maps.stats(self.xmlrpc_uri)
+
+  def get_connection_pool_stats(self):
+    return get_pool(self.xmlrpc_uri, verify_certs=False).stats()
+
 
 class ZoneForm(Form):
   name = StringField('Name', [InputRequired()])
@@ -46,6 +46,7 @@ setup(
         'console_scripts': [
             'health_tasks = lifeguard.bin.health_tasks:run',
             'process_tickets = lifeguard.bin.process_tickets:run',
+            'refresh_inventory = lifeguard.bin.refresh_inventory:run',
         ]
     }
 )